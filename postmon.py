@@ -5,6 +5,15 @@ O postmon-python é um wrapper da API do Postmon.
 As chamadas devem ser feitas para as funções do módulo, que fazem as chamadas
 para o Postmon e retornam objetos com os resultados. Em caso de falha, todas as
 funções retornam `None`.
+
+As funções do módulo, os caches, os transportes, os perfis e os ``contadores``
+podem ser usados por várias threads ao mesmo tempo, inclusive em builds do
+Python sem GIL. Cada chamada cria um objeto novo, então os resultados nunca
+são compartilhados entre threads. Um mesmo objeto, porém, não deve ter o
+``buscar()`` chamado por duas threads simultaneamente. A configuração feita
+nos atributos do ``PostmonModel`` (``base_url``, ``cache``, ``transporte``)
+deve ser feita antes das buscas começarem; cada ``buscar()`` lê a
+configuração uma única vez, então nunca mistura valores antigos e novos.
 """
 
 __title__ = 'postmon'
@@ -12,13 +21,62 @@ __version__ = '0.2'
 __author__ = 'Iuri de Silvio'
 __license__ = 'MIT'
 
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from decimal import Decimal
+from functools import partial
+import argparse
+import gzip
+import json
 import logging
+import math
+import mmap
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import pickle
+import random
+import re
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
 
 import requests
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import socketserver
+    from urllib.parse import unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    import SocketServer as socketserver
+    from urllib import unquote
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 logger = logging.getLogger(__name__)
 
+#: prioridade das buscas feitas para atender um usuário
+INTERATIVA = 'interativa'
+#: prioridade das buscas em lote, como as do ``enderecos()``
+LOTE = 'lote'
+
 
 class PostmonModel(object):
     """Objeto base para os modelos do Postmon."""
@@ -26,6 +84,29 @@ class PostmonModel(object):
     base_url = 'http://api.postmon.com.br/v1'
     base_user_agent = '/'.join([__title__, __version__])
     _user_agent = None
+    # dados da última busca bem sucedida, já decodificados; não são incluídos
+    # no ``to_dict()`` nem no pickle
+    _dados = None
+
+    #: backend de cache consultado pelo ``buscar()``, como um ``CacheMemoria``
+    #: ou ``CacheRedis``. ``None`` desativa o cache.
+    cache = None
+    #: tempo de vida, em segundos, dos resultados gravados no cache
+    cache_ttl = None
+    #: ``Agendador`` que limita as requisições simultâneas e reserva parte
+    #: delas para as buscas interativas. ``None`` não limita as requisições.
+    agendador = None
+    #: ``RastreadorAcessos`` que registra as buscas feitas. ``None`` desativa
+    #: o registro.
+    rastreador = None
+    #: ``CadeiaProvedores`` com as fontes consultadas pelo ``buscar()``, em
+    #: ordem. ``None`` consulta apenas o ``base_url`` pelo ``transporte``.
+    provedores = None
+    #: transporte usado pelo ``buscar()`` para fazer as requisições, como um
+    #: ``TransporteGravador`` ou ``TransporteReplay``, inclusive pelos
+    #: ``ProvedorPostmon`` sem transporte próprio. ``None`` usa o
+    #: ``requests`` diretamente.
+    transporte = None
 
     @property
     def user_agent(self):
@@ -36,27 +117,123 @@ class PostmonModel(object):
         do requests.
         """
         if not self._user_agent:
-            session = requests.Session()
-            user_agent = session.headers['User-Agent']
+            user_agent = requests.utils.default_user_agent()
             self._user_agent = '%s %s' % (self.base_user_agent, user_agent)
         return self._user_agent
 
-    def buscar(self):
+    def buscar(self, prioridade=None):
         """Faz a busca das informações do objeto no Postmon.
 
+        A ``prioridade`` (``INTERATIVA``, o padrão, ou ``LOTE``) é usada pelo
+        ``PostmonModel.agendador``, se houver, para decidir quando a
+        requisição pode ser feita. Uma busca que desiste de esperar pelo
+        agendador (``FilaCheia``) é tratada como falha.
+
         Retorna um ``bool`` indicando se a busca foi bem sucedida.
         """
+        medicao = _Medicao() if _perfis else None
+        contadores.incrementar('buscas')
+        # a configuração é lida uma vez, para não mudar no meio da busca
+        base_url = self.base_url
+        url = base_url + (self.endpoint % self._params)
+        caminho = self._caminho()
+        cache = self.cache
+        rastreador = self.rastreador
+        if rastreador is not None:
+            rastreador.registrar(caminho)
+
+        if cache is not None:
+            try:
+                dados = cache.get(base_url + caminho)
+            except ErroCache:
+                logger.exception("%s.buscar() falhou ao ler o cache" %
+                                 self.__class__.__name__)
+                dados = None
+            if medicao is not None:
+                medicao.fase('cache')
+            if dados is not None:
+                contadores.incrementar('cache')
+                self._response = _RespostaLocal(dados)
+                self._atualizar(dados, medicao)
+                return True
+
         headers = {'User-Agent': self.user_agent}
+        transporte = self.transporte or _TRANSPORTE_PADRAO
+        agendador = self.agendador
+        if self.provedores is not None:
+            requisitar = partial(self.provedores.buscar, self, headers,
+                                 transporte)
+        else:
+            requisitar = partial(transporte.get, url, headers)
         try:
-            self._response = requests.get(self.url, headers=headers)
+            if agendador is None:
+                resposta = requisitar()
+            else:
+                with agendador.vaga(prioridade or INTERATIVA):
+                    if medicao is not None:
+                        # a espera pela vaga não é tempo de transporte
+                        medicao.fase('fila')
+                    resposta = requisitar()
         except requests.RequestException:
             logger.exception("%s.buscar() falhou: GET %s" %
-                             (self.__class__.__name__, self.url))
+                             (self.__class__.__name__, url))
+            contadores.incrementar('erros')
+            if medicao is not None:
+                medicao.fase('transporte')
+                medicao.finalizar(self)
             return False
+        except FilaCheia as e:
+            logger.warning("%s.buscar() desistiu: GET %s: %s" %
+                           (self.__class__.__name__, url, e))
+            contadores.incrementar('fila_cheia')
+            if medicao is not None:
+                medicao.fase('fila')
+                medicao.finalizar(self)
+            return False
+        if medicao is not None:
+            medicao.fase('transporte')
+
+        self._response = resposta
+        if resposta.ok:
+            dados = resposta.json()
+            if medicao is not None:
+                medicao.fase('json')
+            self._atualizar(dados, medicao)
+            if cache is not None:
+                try:
+                    cache.set(base_url + caminho, dados, self.cache_ttl)
+                except ErroCache:
+                    logger.exception("%s.buscar() falhou ao gravar o cache" %
+                                     self.__class__.__name__)
+        else:
+            contadores.incrementar('falhas')
+            if medicao is not None:
+                medicao.finalizar(self)
+        return resposta.ok
+
+    def _atualizar(self, dados, medicao):
+        self._dados = dados
+        if medicao is None:
+            self.atualizar(**dados)
+            return
+        _local.medicao = medicao
+        try:
+            self.atualizar(**dados)
+        finally:
+            _local.medicao = None
+            medicao.fase('atualizar')
+            medicao.finalizar(self)
 
-        if self._response.ok:
-            self.atualizar(**self._response.json())
-        return self._response.ok
+    def _caminho(self):
+        """Caminho normalizado do objeto, usado como chave pelo
+        ``RastreadorAcessos``."""
+        return self.endpoint % self._params
+
+    @property
+    def _chave_cache(self):
+        """Chave do objeto no cache: a URL com o caminho normalizado, para
+        que ``'11111-111'`` e ``'11111111'`` usem a mesma entrada."""
+        return self.base_url + self._caminho()
 
     @property
     def url(self):
@@ -105,6 +282,36 @@ class PostmonModel(object):
         else:
             return r.ok
 
+    def to_dict(self):
+        """Retorna um dicionário compacto com os dados do objeto, que pode ser
+        convertido de volta com o ``from_dict()``.
+
+        Os campos usam nomes curtos, os campos vazios são omitidos e a
+        resposta do Postmon não é incluída; apenas o sucesso da busca é
+        preservado.
+
+            >>> Estado('MG', 'Minas Gerais').to_dict()
+            {'u': 'MG', 'n': 'Minas Gerais'}
+        """
+        d = self._to_dict()
+        if self._ok:
+            d['ok'] = 1
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        """Cria um objeto a partir do dicionário gerado pelo ``to_dict()``,
+        sem passar pelo ``atualizar()``."""
+        obj = cls.__new__(cls)
+        obj._from_dict(d)
+        if d.get('ok'):
+            obj._response = _RespostaLocal()
+        return obj
+
+    def __reduce__(self):
+        # o pickle usa o formato compacto do to_dict()
+        return _de_dict, (self.__class__, self.to_dict())
+
 
 class Cidade(PostmonModel):
     """
@@ -122,6 +329,9 @@ class Cidade(PostmonModel):
         self.area_km2 = area_km2
         self.codigo_ibge = codigo_ibge
 
+    def _caminho(self):
+        return self.endpoint % (self.uf, self.nome)
+
     @property
     def area_km2(self):
         return self._area_km2
@@ -130,6 +340,23 @@ class Cidade(PostmonModel):
     def area_km2(self, value):
         self._area_km2 = _parse_area_km2(value)
 
+    def _to_dict(self, uf=True):
+        return _sem_vazios({'u': self.uf if uf else None, 'n': self.nome,
+                            'a': _str_ou_none(self.area_km2),
+                            'i': self.codigo_ibge})
+
+    def _from_dict(self, d, uf=None):
+        self.uf = d.get('u', uf)
+        self.nome = d['n']
+        self._params = (self.uf, self.nome)
+        self._area_km2 = _decimal_ou_none(d.get('a'))
+        self.codigo_ibge = d.get('i')
+
+    def congelar(self):
+        """Retorna uma ``CidadeCongelada`` com os dados da cidade."""
+        return CidadeCongelada(self.uf, self.nome, self.area_km2,
+                               self.codigo_ibge)
+
     def __repr__(self):
         return '<%s %r>' % (self.__class__.__name__, self.nome)
 
@@ -154,6 +381,9 @@ class Estado(PostmonModel):
         self.area_km2 = area_km2
         self.codigo_ibge = codigo_ibge
 
+    def _caminho(self):
+        return self.endpoint % self.uf
+
     @property
     def area_km2(self):
         return self._area_km2
@@ -162,6 +392,22 @@ class Estado(PostmonModel):
     def area_km2(self, value):
         self._area_km2 = _parse_area_km2(value)
 
+    def _to_dict(self):
+        return _sem_vazios({'u': self.uf, 'n': self.nome,
+                            'a': _str_ou_none(self.area_km2),
+                            'i': self.codigo_ibge})
+
+    def _from_dict(self, d):
+        self.uf = self._params = d['u']
+        self.nome = d.get('n')
+        self._area_km2 = _decimal_ou_none(d.get('a'))
+        self.codigo_ibge = d.get('i')
+
+    def congelar(self):
+        """Retorna um ``EstadoCongelado`` com os dados do estado."""
+        return EstadoCongelado(self.uf, self.nome, self.area_km2,
+                               self.codigo_ibge)
+
     def __repr__(self):
         return '<%s %r>' % (self.__class__.__name__, self.uf)
 
@@ -218,6 +464,42 @@ class Endereco(PostmonModel):
                                      cidade_info.get('area_km2'),
                                      cidade_info.get('codigo_ibge'))
 
+    def _caminho(self):
+        return self.endpoint % _normalizar_cep(self.cep)
+
+    def _to_dict(self):
+        d = _sem_vazios({'c': self.cep, 'l': self.logradouro,
+                         'p': self.complemento, 'b': self.bairro})
+        estado = getattr(self, 'estado', None)
+        if estado is not None:
+            d['e'] = estado._to_dict()
+            cidade = getattr(self, 'cidade', None)
+            if cidade is not None:
+                # a UF da cidade é a mesma do estado
+                d['ci'] = cidade._to_dict(uf=False)
+        return d
+
+    def _from_dict(self, d):
+        self.cep = self._params = d['c']
+        self.logradouro = d.get('l')
+        self.complemento = d.get('p')
+        self.bairro = d.get('b')
+        if 'e' in d:
+            self.estado = Estado.__new__(Estado)
+            self.estado._from_dict(d['e'])
+            if 'ci' in d:
+                self.cidade = Cidade.__new__(Cidade)
+                self.cidade._from_dict(d['ci'], self.estado.uf)
+
+    def congelar(self):
+        """Retorna um ``EnderecoCongelado`` com os dados do endereço."""
+        cidade = getattr(self, 'cidade', None)
+        estado = getattr(self, 'estado', None)
+        return EnderecoCongelado(
+            self.cep, self.logradouro, self.complemento, self.bairro,
+            cidade.congelar() if cidade is not None else None,
+            estado.congelar() if estado is not None else None)
+
     def __repr__(self):
         return '<%s %r>' % (self.__class__.__name__, self.cep)
 
@@ -244,48 +526,451 @@ class Endereco(PostmonModel):
         return ', '.join(p for p in (p1, p2, p3) if p)
 
 
-def cidade(uf, nome):
+def serializar(objetos):
+    """Converte uma lista de objetos ``Endereco``, ``Cidade`` e ``Estado`` em
+    uma estrutura compacta de listas, dicionários e strings, que pode ser
+    convertida de volta com o ``desserializar()``.
+
+    Cada cidade e estado diferente é gravado uma única vez em uma tabela,
+    referenciada pelos objetos.
+    """
+    tabela = []
+    indices = {}
+
+    def indice(d):
+        chave = tuple(sorted(d.items()))
+        try:
+            return indices[chave]
+        except KeyError:
+            indices[chave] = len(tabela)
+            tabela.append(d)
+            return indices[chave]
+
+    linhas = []
+    for obj in objetos:
+        d = obj.to_dict()
+        if isinstance(obj, Endereco):
+            if 'e' in d:
+                d['e'] = indice(d['e'])
+            if 'ci' in d:
+                d['ci'] = indice(d['ci'])
+        else:
+            ok = d.pop('ok', None)
+            d = {'k': _TIPOS_SERIALIZADOS[obj.__class__], 'r': indice(d)}
+            if ok:
+                d['ok'] = 1
+        linhas.append(d)
+    return {'v': _SERIALIZACAO_VERSAO, 't': tabela, 'o': linhas}
+
+
+def desserializar(dados):
+    """Converte a estrutura gerada pelo ``serializar()`` de volta em uma
+    lista de objetos."""
+    if dados.get('v') != _SERIALIZACAO_VERSAO:
+        raise ValueError('versão de serialização não suportada: %r' %
+                         dados.get('v'))
+    tabela = dados['t']
+    objetos = []
+    for d in dados['o']:
+        tipo = d.get('k')
+        if tipo is None:
+            d = dict(d)
+            if 'e' in d:
+                d['e'] = tabela[d['e']]
+            if 'ci' in d:
+                d['ci'] = tabela[d['ci']]
+            objetos.append(Endereco.from_dict(d))
+        else:
+            cls = Cidade if tipo == 'c' else Estado
+            obj = cls.from_dict(tabela[d['r']])
+            if d.get('ok'):
+                obj._response = _RespostaLocal()
+            objetos.append(obj)
+    return objetos
+
+
+def empacotar(objetos):
+    """Serializa os objetos com o ``serializar()`` e os empacota em bytes
+    com o ``msgpack`` (``pip install postmon[msgpack]``)."""
+    if msgpack is None:
+        raise ImportError('o empacotar() depende do msgpack: '
+                          'pip install postmon[msgpack]')
+    return msgpack.packb(serializar(objetos), use_bin_type=True)
+
+
+def desempacotar(dados):
+    """Converte os bytes gerados pelo ``empacotar()`` em uma lista de
+    objetos."""
+    if msgpack is None:
+        raise ImportError('o desempacotar() depende do msgpack: '
+                          'pip install postmon[msgpack]')
+    return desserializar(msgpack.unpackb(dados, raw=False))
+
+
+_SERIALIZACAO_VERSAO = 1
+_TIPOS_SERIALIZADOS = {Cidade: 'c', Estado: 'u'}
+
+
+def _de_dict(cls, d):
+    return cls.from_dict(d)
+
+
+def _sem_vazios(d):
+    return dict((k, v) for k, v in d.items() if v is not None)
+
+
+def _str_ou_none(valor):
+    return None if valor is None else str(valor)
+
+
+def _decimal_ou_none(valor):
+    return None if valor is None else Decimal(valor)
+
+
+class _Congelado(object):
+    """Base dos objetos imutáveis retornados pelo ``congelar()``.
+
+    A igualdade e o hash dependem apenas da ``chave`` canônica do objeto,
+    calculada na criação. A própria ``chave`` pode ser usada para cruzar os
+    resultados com outras tabelas, sem criar novos objetos.
+    """
+
+    __slots__ = ('chave', '_hash')
+    _campos = ()
+
+    def __init__(self, *valores):
+        for campo, valor in zip(self._campos, valores):
+            object.__setattr__(self, campo, valor)
+        chave = self._chave()
+        object.__setattr__(self, 'chave', chave)
+        object.__setattr__(self, '_hash', hash(chave))
+
+    def __setattr__(self, nome, valor):
+        raise AttributeError('%s é imutável' % self.__class__.__name__)
+
+    def __delattr__(self, nome):
+        raise AttributeError('%s é imutável' % self.__class__.__name__)
+
+    def __eq__(self, outro):
+        if self.__class__ is not outro.__class__:
+            return NotImplemented
+        return self._hash == outro._hash and self.chave == outro.chave
+
+    def __ne__(self, outro):
+        igual = self.__eq__(outro)
+        return igual if igual is NotImplemented else not igual
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return self.__class__, tuple(getattr(self, c) for c in self._campos)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.chave)
+
+
+class EstadoCongelado(_Congelado):
+    """Versão imutável e hashable do ``Estado``, identificada pela UF.
+
+        >>> EstadoCongelado('mg') == Estado('MG', 'Minas Gerais').congelar()
+        True
+    """
+
+    __slots__ = _campos = ('uf', 'nome', 'area_km2', 'codigo_ibge')
+
+    def __init__(self, uf, nome=None, area_km2=None, codigo_ibge=None):
+        _Congelado.__init__(self, uf.upper(), nome, area_km2, codigo_ibge)
+
+    def _chave(self):
+        return self.uf
+
+    def __str__(self):
+        return self.uf
+
+
+class CidadeCongelada(_Congelado):
+    """Versão imutável e hashable da ``Cidade``, identificada pela UF e pelo
+    nome, como ``'MG/Belo Horizonte'``.
+
+    O ``codigo_ibge`` não faz parte da chave, já que nem toda resposta do
+    Postmon o informa; a mesma cidade com e sem ele é considerada igual.
+
+        >>> a = CidadeCongelada('mg', 'Belo Horizonte', codigo_ibge='3106200')
+        >>> a == CidadeCongelada('MG', 'Belo Horizonte'), a.chave
+        (True, 'MG/Belo Horizonte')
+    """
+
+    __slots__ = _campos = ('uf', 'nome', 'area_km2', 'codigo_ibge')
+
+    def __init__(self, uf, nome, area_km2=None, codigo_ibge=None):
+        _Congelado.__init__(self, uf.upper(), nome, area_km2, codigo_ibge)
+
+    def _chave(self):
+        return '%s/%s' % (self.uf, self.nome)
+
+    def __str__(self):
+        return '%s - %s' % (self.nome, self.uf)
+
+
+class EnderecoCongelado(_Congelado):
+    """Versão imutável e hashable do ``Endereco``, identificada pelo CEP
+    apenas com dígitos.
+
+        >>> e = EnderecoCongelado('11111-111')
+        >>> e == EnderecoCongelado('11111111'), e.chave
+        (True, '11111111')
+        >>> len(set([e, EnderecoCongelado('11111111')]))
+        1
+    """
+
+    __slots__ = _campos = ('cep', 'logradouro', 'complemento', 'bairro',
+                           'cidade', 'estado')
+
+    def __init__(self, cep, logradouro=None, complemento=None, bairro=None,
+                 cidade=None, estado=None):
+        _Congelado.__init__(self, cep, logradouro, complemento, bairro,
+                            cidade, estado)
+
+    def _chave(self):
+        return _normalizar_cep(self.cep)
+
+
+def cidade(uf, nome, prioridade=None):
     """Busca a cidade no Postmon e retorna um objeto ``Cidade``.
 
     Retorna ``None`` caso a cidade não exista ou caso ocorra algum erro de
-    comunicação.
+    comunicação. A ``prioridade`` é repassada para o ``buscar()``.
 
         >>> import postmon
         >>> postmon.cidade('MG', 'Belo Horizonte')
         <Cidade 'Belo Horizonte'>
     """
-    return _make_object(Cidade, uf, nome)
+    return _make_object(Cidade, uf, nome, prioridade=prioridade)
 
 
-def estado(uf):
+def estado(uf, prioridade=None):
     """Busca o estado no Postmon e retorna um objeto ``Estado``.
 
     Retorna ``None`` caso o estado não exista ou caso ocorra algum erro de
-    comunicação.
+    comunicação. A ``prioridade`` é repassada para o ``buscar()``.
 
         >>> import postmon
         >>> postmon.estado('MG')
         <Estado 'MG'>
     """
-    return _make_object(Estado, uf)
+    return _make_object(Estado, uf, prioridade=prioridade)
 
 
-def endereco(cep):
+def endereco(cep, prioridade=None):
     """Busca o CEP no Postmon e retorna um objeto ``Endereco``.
 
     Retorna ``None`` caso o CEP não exista ou caso ocorra algum erro de
-    comunicação.
+    comunicação. A ``prioridade`` é repassada para o ``buscar()``.
 
         >>> import postmon
         >>> postmon.endereco('11111-111')
         <Endereco '11111-111'>
     """
-    return _make_object(Endereco, cep)
+    return _make_object(Endereco, cep, prioridade=prioridade)
+
+
+def enderecos(ceps, processos=None, progresso=None, tamanho_prefixo=2,
+              tamanho_lote=500, concorrencia=1, prioridade=LOTE):
+    """Busca vários CEPs no Postmon, dividindo o trabalho entre processos.
+
+    Os CEPs são agrupados pelos ``tamanho_prefixo`` primeiros dígitos, de forma
+    que cada lote enviado para um processo contenha CEPs da mesma região.
+
+    Retorna uma lista na mesma ordem de ``ceps``, com um objeto ``Endereco``
+    para cada CEP encontrado ou ``None`` em caso de falha.
+
+    Se nenhum ``PostmonModel.transporte`` estiver configurado, cada processo
+    usa um ``TransporteRequests`` com sessões próprias, reaproveitando
+    conexões. Com
+    ``concorrencia`` maior que 1, cada processo faz até essa quantidade de
+    buscas simultâneas, que o ``TransporteHttp2`` multiplexa em poucas
+    conexões.
+
+    ``processos`` é o número de processos (padrão: número de CPUs) e
+    ``progresso``, se informado, é chamado como ``progresso(feitos, total)`` a
+    cada lote concluído.
+
+    Com ``processos=0``, as buscas são feitas no próprio processo, em até
+    ``concorrencia`` threads, e passam pelo ``PostmonModel.agendador`` com a
+    ``prioridade`` informada (por padrão, ``LOTE``). Nos processos separados
+    o agendador não é usado.
+
+    Se houver um ``PostmonModel.cache``, todos os CEPs são consultados nele
+    com um único ``mget()`` e apenas os que faltam são enviados aos processos.
+
+    O ``base_url``, o ``base_user_agent``, o ``transporte``, os
+    ``provedores`` e o ``cache_ttl`` do ``PostmonModel`` são enviados para os
+    processos. Quando os processos não são criados por ``fork`` (como no
+    Windows, no macOS e com ``forkserver``), essa configuração precisa
+    poder ser serializada com ``pickle``; se não puder, é levantado
+    ``ValueError`` antes de qualquer busca.
+
+    Em caso de ``KeyboardInterrupt`` ou outro erro, os processos são
+    encerrados antes da exceção ser propagada.
+    """
+    ceps = list(ceps)
+    total = len(ceps)
+    resultado = [None] * total
+    if not total:
+        return resultado
+
+    cache = PostmonModel.cache
+    feitos = 0
+    pendentes = list(range(total))
+    if cache is not None:
+        pendentes = []
+        for i, dados in enumerate(_cache_mget(cache, [Endereco(c)._chave_cache
+                                                      for c in ceps])):
+            if dados is None:
+                pendentes.append(i)
+            else:
+                e = resultado[i] = Endereco(ceps[i])
+                e._response = _RespostaLocal(dados)
+                e.atualizar(**dados)
+        feitos = total - len(pendentes)
+        if progresso is not None and feitos:
+            progresso(feitos, total)
+        if not pendentes:
+            return resultado
+
+    lotes = [([pendentes[i] for i in indices], parte) for indices, parte in
+             _particionar([ceps[i] for i in pendentes], tamanho_prefixo,
+                          tamanho_lote)]
+    if processos == 0:
+        # no próprio processo, o buscar() já grava o cache
+        pool = ThreadPool(concorrencia)
+        cache = None
+    else:
+        configuracao = _configuracao_worker()
+        pool = multiprocessing.Pool(processos, initializer=_iniciar_worker,
+                                    initargs=(configuracao, concorrencia))
+    buscar_lote = partial(_buscar_lote, prioridade=prioridade,
+                          com_dados=cache is not None)
+    try:
+        resultados = pool.imap_unordered(buscar_lote, lotes)
+        for indices, enderecos_, dados in resultados:
+            for i, e in zip(indices, enderecos_):
+                resultado[i] = e
+            if dados:
+                _cache_mset(cache, dados, Endereco.cache_ttl)
+            feitos += len(indices)
+            if progresso is not None:
+                progresso(feitos, total)
+    except BaseException:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+    return resultado
+
+
+def _particionar(ceps, tamanho_prefixo, tamanho_lote):
+    """Agrupa os CEPs pelo prefixo e divide os grupos em lotes de até
+    ``tamanho_lote`` itens.
+
+    Retorna uma lista de tuplas ``(indices, ceps)``, ordenada pelo prefixo.
+    """
+    grupos = {}
+    for i, cep in enumerate(ceps):
+        prefixo = _normalizar_cep(cep)[:tamanho_prefixo]
+        grupos.setdefault(prefixo, []).append(i)
+
+    lotes = []
+    for prefixo in sorted(grupos):
+        indices = grupos[prefixo]
+        for inicio in range(0, len(indices), tamanho_lote):
+            parte = indices[inicio:inicio + tamanho_lote]
+            lotes.append((parte, [ceps[i] for i in parte]))
+    return lotes
 
 
-def _make_object(cls, *args):
+def _normalizar_cep(cep):
+    """Remove tudo que não for dígito do CEP.
+
+    >>> _normalizar_cep('11111-111')
+    '11111111'
+    """
+    return re.sub(r'\D', '', cep)
+
+
+# pool de threads de cada processo do ``enderecos()``
+_threads_worker = None
+# atributos do ``PostmonModel`` enviados para os processos do ``enderecos()``
+_CONFIGURACAO_WORKER = ('base_url', 'base_user_agent', 'transporte',
+                        'provedores', 'cache_ttl')
+
+
+def _configuracao_worker():
+    """Retorna a configuração do ``PostmonModel`` usada pelos processos do
+    ``enderecos()``, verificando se ela pode ser enviada a eles."""
+    configuracao = dict((nome, getattr(PostmonModel, nome))
+                        for nome in _CONFIGURACAO_WORKER)
+    if _metodo_inicio() != 'fork':
+        # sem fork, os argumentos dos processos são enviados com pickle
+        try:
+            pickle.dumps(configuracao)
+        except Exception as e:
+            raise ValueError('a configuração do PostmonModel não pode ser '
+                             'enviada aos processos (%s); use processos=0 '
+                             'ou objetos que suportem pickle' % e)
+    return configuracao
+
+
+def _metodo_inicio():
+    try:
+        return multiprocessing.get_start_method()
+    except AttributeError:
+        # o Python 2 sempre usa fork
+        return 'fork'
+
+
+def _iniciar_worker(configuracao, concorrencia):
+    global _threads_worker
+    # o processo principal é quem trata o Ctrl+C e encerra os workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for nome, valor in configuracao.items():
+        setattr(PostmonModel, nome, valor)
+    # o cache é lido e gravado em lote pelo processo principal
+    PostmonModel.cache = None
+    # as prioridades só fazem sentido no processo que recebe as buscas
+    # interativas
+    PostmonModel.agendador = None
+    if PostmonModel.transporte is None:
+        PostmonModel.transporte = TransporteRequests(sessoes=True)
+    if concorrencia > 1:
+        _threads_worker = ThreadPool(concorrencia)
+
+
+def _buscar_lote(lote, prioridade, com_dados):
+    """Busca um lote de CEPs.
+
+    Retorna os índices, os objetos encontrados e, se ``com_dados``, as
+    respostas do Postmon para serem gravadas no cache, já que os objetos são
+    enviados ao processo principal sem elas.
+    """
+    indices, ceps = lote
+    buscar = partial(_make_object, Endereco, prioridade=prioridade)
+    if _threads_worker is not None:
+        enderecos_ = _threads_worker.map(buscar, ceps)
+    else:
+        enderecos_ = [buscar(cep) for cep in ceps]
+    dados = None
+    if com_dados:
+        dados = dict((e._chave_cache, e._dados)
+                     for e in enderecos_ if e is not None)
+    return indices, enderecos_, dados
+
+
+def _make_object(cls, *args, **kwargs):
     obj = cls(*args)
-    return obj if obj.buscar() else None
+    return obj if obj.buscar(**kwargs) else None
 
 
 def _parse_area_km2(valor):
@@ -294,6 +979,18 @@ def _parse_area_km2(valor):
 
     Exemplos: "331,401", "248.222,801"
     """
+    if _perfis:
+        medicao = getattr(_local, 'medicao', None)
+        if medicao is not None:
+            inicio = _relogio()
+            try:
+                return _converter_area_km2(valor)
+            finally:
+                medicao.subfase('area_km2', _relogio() - inicio)
+    return _converter_area_km2(valor)
+
+
+def _converter_area_km2(valor):
     if valor is None:
         return None
     elif isinstance(valor, Decimal):
@@ -310,13 +1007,1675 @@ def _parse_area_km2(valor):
     return Decimal('%s.%s' % (int_, dec))
 
 
-# patch das chamadas para o Postmon
+class Contadores(object):
+    """Contadores de eventos que podem ser incrementados por várias threads
+    sem lock.
+
+    Cada thread incrementa os seus próprios contadores, então nenhum
+    incremento se perde. O ``valores()`` soma os contadores de todas as
+    threads. Os contadores das threads que já terminaram são incorporados a
+    um total único sempre que uma nova thread é registrada, então a memória
+    usada depende apenas do número de threads vivas.
+
+    O ``buscar()`` usa os contadores do módulo, ``postmon.contadores``:
+    ``buscas``, ``cache`` (buscas atendidas pelo cache), ``falhas``
+    (respostas de erro do Postmon), ``erros`` (falhas de comunicação) e
+    ``fila_cheia`` (buscas que desistiram de esperar pelo ``Agendador``).
+
+        >>> c = Contadores()
+        >>> c.incrementar('buscas')
+        >>> c.incrementar('buscas', 2)
+        >>> c.valores()
+        {'buscas': 3}
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._threads = []
+        self._encerradas = {}
+        self._zero = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, nome, n=1):
+        try:
+            valores = self._local.valores
+        except AttributeError:
+            valores = self._local.valores = {}
+            with self._lock:
+                self._recolher()
+                self._threads.append((threading.current_thread(), valores))
+        valores[nome] = valores.get(nome, 0) + n
+
+    def valores(self):
+        """Retorna um dicionário com o total de cada contador."""
+        with self._lock:
+            return self._somar()
+
+    def zerar(self):
+        """Zera todos os contadores."""
+        with self._lock:
+            self._zero = {}
+            self._zero = self._somar()
+
+    def _recolher(self):
+        """Incorpora os contadores das threads encerradas ao total delas."""
+        ativas = []
+        for thread, valores in self._threads:
+            if thread.is_alive():
+                ativas.append((thread, valores))
+            else:
+                _somar_em(self._encerradas, valores)
+        self._threads = ativas
+
+    def _somar(self):
+        self._recolher()
+        total = dict(self._encerradas)
+        for _, valores in self._threads:
+            _somar_em(total, valores)
+        for nome, n in self._zero.items():
+            total[nome] -= n
+        return total
+
+
+def _somar_em(total, valores):
+    for nome, n in dict(valores).items():
+        total[nome] = total.get(nome, 0) + n
+
+
+contadores = Contadores()
+
+
+class FilaCheia(Exception):
+    """A busca em lote esperou mais que o ``timeout`` do ``Agendador``."""
+
+
+class Agendador(object):
+    """Limita as requisições simultâneas, reservando parte delas para as
+    buscas interativas.
+
+    Até ``capacidade`` requisições são feitas ao mesmo tempo, das quais no
+    máximo ``capacidade - reservadas`` podem ser buscas em ``LOTE``. As buscas
+    ``INTERATIVA`` têm preferência sobre as buscas em lote que estão
+    esperando.
+
+    No máximo ``max_fila`` buscas em lote esperam por uma vaga; as demais
+    ficam bloqueadas antes de entrar na fila, segurando quem as produz. Com
+    ``timeout``, uma busca em lote que esperar mais que ``timeout`` segundos
+    levanta ``FilaCheia``.
+
+        postmon.PostmonModel.agendador = postmon.Agendador(10, reservadas=4)
+    """
+
+    def __init__(self, capacidade=10, reservadas=2, max_fila=100,
+                 timeout=None):
+        if not 0 <= reservadas < capacidade:
+            raise ValueError('reservadas deve estar entre 0 e capacidade - 1')
+        self.capacidade = capacidade
+        self.reservadas = reservadas
+        self.max_fila = max_fila
+        self.timeout = timeout
+        self._em_uso = 0
+        self._em_uso_lote = 0
+        self._fila = 0
+        self._interativas = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def vaga(self, prioridade=INTERATIVA):
+        """Espera uma vaga para a ``prioridade`` e a libera ao final do
+        bloco."""
+        lote = prioridade == LOTE
+        if lote:
+            self._adquirir_lote()
+        else:
+            self._adquirir_interativa()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._em_uso -= 1
+                if lote:
+                    self._em_uso_lote -= 1
+                self._cond.notify_all()
+
+    def estado(self):
+        """Retorna quantas requisições estão em andamento (``em_uso``, das
+        quais ``lote`` em lote) e quantas buscas em lote (``fila``) e
+        interativas (``interativas``) estão esperando."""
+        with self._cond:
+            return {'em_uso': self._em_uso, 'lote': self._em_uso_lote,
+                    'fila': self._fila, 'interativas': self._interativas}
+
+    def _adquirir_interativa(self):
+        with self._cond:
+            self._interativas += 1
+            try:
+                while self._em_uso >= self.capacidade:
+                    self._cond.wait()
+            finally:
+                self._interativas -= 1
+            self._em_uso += 1
+
+    def _adquirir_lote(self):
+        limite = None
+        if self.timeout is not None:
+            limite = time.time() + self.timeout
+        with self._cond:
+            while self._fila >= self.max_fila:
+                self._esperar(limite)
+            self._fila += 1
+            try:
+                while (self._interativas or
+                       self._em_uso >= self.capacidade or
+                       self._em_uso_lote >=
+                       self.capacidade - self.reservadas):
+                    self._esperar(limite)
+            finally:
+                self._fila -= 1
+                # libera quem espera para entrar na fila
+                self._cond.notify_all()
+            self._em_uso += 1
+            self._em_uso_lote += 1
+
+    def _esperar(self, limite):
+        if limite is None:
+            self._cond.wait()
+            return
+        restante = limite - time.time()
+        if restante <= 0:
+            raise FilaCheia('nenhuma vaga em %s segundos' % self.timeout)
+        self._cond.wait(restante)
+
+
+class Perfil(object):
+    """Tempos das fases de cada ``buscar()`` feito enquanto o perfil estava
+    ativo, agrupados pelo ``endpoint``.
+
+    As fases são ``cache`` (consulta ao cache), ``fila`` (espera por uma
+    vaga no ``PostmonModel.agendador``, quando houver), ``transporte``
+    (conexão, envio e espera pela resposta), ``json`` (decodificação da
+    resposta), ``atualizar`` (preenchimento do objeto) e
+    ``atualizar;area_km2`` (conversão das áreas para ``Decimal``, descontada
+    do ``atualizar``).
+    ``total`` é o tempo do ``buscar()`` inteiro.
+
+    É criado pelo ``perfilar()``.
+    """
+
+    def __init__(self):
+        self.tempos = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, endpoint, fases, total):
+        with self._lock:
+            tempos = self.tempos.setdefault(endpoint, {})
+            for fase, duracao in fases:
+                tempos.setdefault(fase, []).append(duracao)
+            tempos.setdefault('total', []).append(total)
+
+    def resumo(self):
+        """Retorna ``{endpoint: {fase: estatisticas}}``, com o número de
+        medições (``n``), o tempo ``total`` e os percentis ``p50``, ``p90``,
+        ``p99`` e ``max``, em segundos.
+        """
+        with self._lock:
+            tempos = dict((endpoint, dict((fase, sorted(duracoes))
+                                          for fase, duracoes in f.items()))
+                          for endpoint, f in self.tempos.items())
+        resumo = {}
+        for endpoint, fases in tempos.items():
+            resumo[endpoint] = dict((fase, _estatisticas(duracoes))
+                                    for fase, duracoes in fases.items())
+        return resumo
+
+    def pilhas(self):
+        """Retorna o tempo acumulado de cada fase no formato de pilhas
+        colapsadas usado pelo ``flamegraph.pl`` e ferramentas compatíveis,
+        em microssegundos.
+
+            Cidade.buscar;transporte 1520
+            Cidade.buscar;atualizar;area_km2 12
+        """
+        linhas = []
+        with self._lock:
+            for endpoint, fases in sorted(self.tempos.items()):
+                for fase, duracoes in sorted(fases.items()):
+                    if fase == 'total':
+                        continue
+                    micro = int(round(sum(duracoes) * 1e6))
+                    linhas.append('%s;%s %d' % (endpoint, fase, micro))
+        return '\n'.join(linhas)
+
+
+def _estatisticas(duracoes):
+    """Calcula as estatísticas de uma lista ordenada de durações."""
+    n = len(duracoes)
+
+    def percentil(p):
+        return duracoes[min(n - 1, int(math.ceil(p * n)) - 1)]
+
+    return {'n': n, 'total': sum(duracoes), 'p50': percentil(0.5),
+            'p90': percentil(0.9), 'p99': percentil(0.99),
+            'max': duracoes[-1]}
+
+
+class _Medicao(object):
+    """Tempos das fases de um ``buscar()``."""
+
+    def __init__(self):
+        self.fases = []
+        self.inicio = self._marca = _relogio()
+        self._subfases = []
+
+    def fase(self, nome):
+        """Encerra a fase ``nome``, iniciada ao fim da fase anterior.
+
+        O tempo das subfases registradas durante a fase é descontado dela.
+        """
+        agora = _relogio()
+        subfases = sum(duracao for _, duracao in self._subfases)
+        self.fases.append((nome, agora - self._marca - subfases))
+        self.fases.extend(('%s;%s' % (nome, subfase), duracao)
+                          for subfase, duracao in self._subfases)
+        self._marca = agora
+        self._subfases = []
+
+    def subfase(self, nome, duracao):
+        """Registra uma subfase da fase em andamento."""
+        self._subfases.append((nome, duracao))
+
+    def finalizar(self, obj):
+        total = _relogio() - self.inicio
+        endpoint = '%s.buscar' % obj.__class__.__name__
+        for perfil in list(_perfis):
+            perfil.registrar(endpoint, self.fases, total)
+
+
+# perfis ativos; a lista vazia mantém o ``buscar()`` sem medições
+_perfis = []
+_local = threading.local()
+_relogio = getattr(time, 'perf_counter', time.time)
+
+
+@contextmanager
+def perfilar():
+    """Mede as fases de todos os ``buscar()`` feitos dentro do bloco, em
+    qualquer thread do processo.
+
+    Retorna um ``Perfil``::
+
+        with postmon.perfilar() as perfil:
+            postmon.endereco('01419101')
+        print(perfil.resumo())
+        print(perfil.pilhas())
+
+    Buscas feitas pelos processos do ``enderecos()`` não são medidas.
+    """
+    perfil = Perfil()
+    _perfis.append(perfil)
+    try:
+        yield perfil
+    finally:
+        _perfis.remove(perfil)
+
+
+class Provedor(object):
+    """Fonte de dados consultada por uma ``CadeiaProvedores``.
+
+    O ``buscar(obj, headers, timeout, transporte)`` recebe o objeto buscado
+    (``Endereco``, ``Cidade`` ou ``Estado``) e o transporte do
+    ``PostmonModel``, e retorna uma resposta como a dos transportes, com os
+    dados no formato do Postmon, ou ``None`` se a fonte não tem o objeto e a
+    próxima deve ser consultada. Falhas são informadas com
+    ``requests.RequestException``.
+
+    ``orcamento`` é o tempo máximo, em segundos, que a fonte tem para
+    responder antes da cadeia passar para a próxima, contando a conexão e a
+    leitura da resposta inteira. ``None``, usado pelas fontes locais, não
+    limita o tempo.
+
+    ``max_pendentes`` é o número máximo de chamadas em andamento na fonte,
+    contando as que já passaram do orçamento e foram abandonadas pela cadeia.
+    Quando ele é atingido, a fonte é pulada.
+    """
+
+    orcamento = None
+    max_pendentes = 4
+
+    def buscar(self, obj, headers, timeout, transporte=None):
+        raise NotImplementedError
+
+    def guardar(self, obj, dados):
+        """Recebe os dados encontrados por uma fonte seguinte da cadeia."""
+
+
+class ProvedorLocal(Provedor):
+    """Fonte de dados local, sem requisições.
+
+    ``dados`` é um dicionário (ou qualquer objeto com ``get()``) com os dados
+    no formato do Postmon, indexados pelo caminho normalizado do objeto, com o
+    CEP apenas com dígitos e a UF em maiúsculas, como ``'/cep/01419101'`` ou
+    ``'/uf/SP'``.
+    """
+
+    def __init__(self, dados):
+        self.dados = dados
+
+    def buscar(self, obj, headers, timeout, transporte=None):
+        dados = self.dados.get(obj._caminho())
+        return _RespostaLocal(dados) if dados is not None else None
+
+
+class ProvedorCache(Provedor):
+    """Fonte de dados que consulta um ``Cache``, guardando nele os dados
+    encontrados pelas fontes seguintes da cadeia."""
+
+    def __init__(self, cache, ttl=None):
+        self.cache = cache
+        self.ttl = ttl
+
+    def buscar(self, obj, headers, timeout, transporte=None):
+        try:
+            dados = self.cache.get(obj._chave_cache)
+        except ErroCache:
+            logger.exception("falha ao ler o cache")
+            return None
+        return _RespostaLocal(dados) if dados is not None else None
+
+    def guardar(self, obj, dados):
+        try:
+            self.cache.set(obj._chave_cache, dados, self.ttl)
+        except ErroCache:
+            logger.exception("falha ao gravar o cache")
+
+
+class ProvedorPostmon(Provedor):
+    """Fonte de dados compatível com o Postmon, em ``base_url``.
+
+    Outras APIs podem ser usadas redefinindo ``url()``, que monta a URL
+    consultada, e ``converter()``, que converte a resposta para o formato do
+    Postmon. Respostas ``5xx`` são tratadas como falha da fonte; as demais
+    (como o ``404`` de um CEP inexistente) encerram a cadeia.
+
+    Toda fonte remota precisa de um ``orcamento``; por padrão, 2 segundos.
+    As requisições são feitas pelo ``transporte`` informado ou, se nenhum for,
+    pelo transporte recebido da cadeia, o do ``PostmonModel``.
+    """
+
+    def __init__(self, base_url, orcamento=2.0, transporte=None,
+                 max_pendentes=4):
+        if orcamento is None or orcamento <= 0:
+            raise ValueError('orcamento deve ser um número positivo')
+        self.base_url = base_url
+        self.orcamento = orcamento
+        self.transporte = transporte
+        self.max_pendentes = max_pendentes
+
+    def url(self, obj):
+        return self.base_url + (obj.endpoint % obj._params)
+
+    def converter(self, dados):
+        return dados
+
+    def buscar(self, obj, headers, timeout, transporte=None):
+        transporte = self.transporte or transporte or _TRANSPORTE_PADRAO
+        url = self.url(obj)
+        resposta = transporte.get(url, headers, timeout)
+        if resposta.status_code >= 500:
+            raise requests.HTTPError('%s %s: GET %s' % (
+                resposta.status_code, resposta.reason, url))
+        if resposta.ok:
+            return _RespostaLocal(self.converter(resposta.json()))
+        return resposta
+
+
+class CadeiaProvedores(object):
+    """Consulta uma lista de ``Provedor`` em ordem, até um deles responder.
+
+    Cada fonte tem o seu ``orcamento`` de tempo; uma fonte lenta ou fora do
+    ar custa no máximo o seu orçamento antes da próxima ser consultada. As
+    fontes com orçamento são consultadas por até ``max_pendentes`` threads
+    próprias; a chamada que passa do orçamento é abandonada pela cadeia,
+    então mesmo uma resposta enviada aos poucos não a atrasa. Enquanto todas
+    as threads de uma fonte estiverem ocupadas, ela é pulada, o que limita as
+    requisições feitas a uma fonte degradada, mesmo fora do ``Agendador``.
+    Os dados encontrados são repassados para o ``guardar()`` das fontes
+    anteriores, como o ``ProvedorCache``::
+
+        postmon.PostmonModel.provedores = postmon.CadeiaProvedores([
+            postmon.ProvedorLocal(dados_locais),
+            postmon.ProvedorCache(postmon.CacheMemoria()),
+            postmon.ProvedorPostmon('http://api.postmon.com.br/v1', 0.5),
+            postmon.ProvedorPostmon('http://postmon.interno/v1', 1.0),
+        ])
+
+    Se nenhuma fonte responder, levanta ``requests.ConnectionError``.
+    """
+
+    def __init__(self, provedores):
+        self.provedores = list(provedores)
+        self._executores = [None if p.orcamento is None
+                            else _Executor(p.max_pendentes)
+                            for p in self.provedores]
+
+    def buscar(self, obj, headers, transporte=None):
+        falhas = []
+        for i, provedor in enumerate(self.provedores):
+            executor = self._executores[i]
+            try:
+                if executor is None:
+                    resposta = provedor.buscar(obj, headers, None,
+                                               transporte)
+                else:
+                    resposta = executor.executar(
+                        provedor.orcamento, provedor.buscar, obj, headers,
+                        provedor.orcamento, transporte)
+            except requests.RequestException as e:
+                logger.warning("%s falhou: %s" %
+                               (provedor.__class__.__name__, e))
+                contadores.incrementar('falhas_provedor')
+                falhas.append('%s: %s' % (provedor.__class__.__name__, e))
+                continue
+            if resposta is None:
+                continue
+            if resposta.ok:
+                dados = resposta.json()
+                for anterior in self.provedores[:i]:
+                    anterior.guardar(obj, dados)
+            return resposta
+        raise requests.ConnectionError('nenhum provedor respondeu %s (%s)' %
+                                       (obj.endpoint % obj._params,
+                                        '; '.join(falhas)))
+
+    def __getstate__(self):
+        # as threads das fontes não são copiadas
+        return {'provedores': self.provedores}
+
+    def __setstate__(self, estado):
+        self.__init__(**estado)
+
+
+class _Executor(object):
+    """Executa chamadas com prazo em até ``maximo`` threads, reaproveitadas
+    entre as chamadas.
+
+    Uma chamada que passa do prazo continua ocupando a sua thread até
+    terminar sozinha, já que threads não podem ser interrompidas. Com as
+    ``maximo`` threads ocupadas, novas chamadas são recusadas com
+    ``requests.ConnectionError``, sem esperar.
+    """
+
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self._tarefas = queue.Queue()
+        self._threads = 0
+        self._ocupadas = 0
+        self._lock = threading.Lock()
+
+    def executar(self, prazo, funcao, *args):
+        with self._lock:
+            if self._ocupadas >= self.maximo:
+                raise requests.ConnectionError(
+                    '%d chamadas ainda em andamento' % self._ocupadas)
+            self._ocupadas += 1
+            # toda tarefa na fila tem uma thread que vai atendê-la
+            nova = self._threads < self._ocupadas
+            if nova:
+                self._threads += 1
+        if nova:
+            thread = threading.Thread(target=self._trabalhar,
+                                      name='postmon-prazo')
+            thread.daemon = True
+            thread.start()
+        tarefa = _Tarefa(funcao, args)
+        self._tarefas.put(tarefa)
+        if not tarefa.pronta.wait(prazo):
+            raise requests.Timeout('sem resposta em %s segundos' % prazo)
+        if tarefa.erro is not None:
+            raise tarefa.erro
+        return tarefa.resultado
+
+    def em_andamento(self):
+        """Retorna o número de chamadas em andamento, inclusive as que já
+        passaram do prazo."""
+        with self._lock:
+            return self._ocupadas
+
+    def _trabalhar(self):
+        while True:
+            tarefa = self._tarefas.get()
+            tarefa.executar()
+            with self._lock:
+                self._ocupadas -= 1
+
+
+class _Tarefa(object):
+
+    def __init__(self, funcao, args):
+        self.funcao = funcao
+        self.args = args
+        self.resultado = self.erro = None
+        self.pronta = threading.Event()
+
+    def executar(self):
+        try:
+            self.resultado = self.funcao(*self.args)
+        except Exception as e:
+            self.erro = e
+        self.pronta.set()
+
+
+class RastreadorAcessos(object):
+    """Registra quais objetos são buscados e com que frequência, usando uma
+    quantidade limitada de memória, para ajudar a dimensionar os caches.
+
+    As chaves são os caminhos normalizados dos objetos, com o CEP apenas com
+    dígitos e a UF em maiúsculas, como ``'/cep/01419101'`` ou ``'/uf/SP'``.
+    São mantidos:
+
+     * as ``k`` chaves mais buscadas, pelo algoritmo *Space-Saving*: quando
+       uma chave nova chega com a tabela cheia, ela substitui a chave de
+       menor contagem e herda essa contagem como erro máximo. As chaves são
+       agrupadas pela contagem, então incrementar e substituir uma chave
+       custa O(1), independente de ``k``;
+     * as últimas ``amostra`` buscas, usadas para simular a taxa de acerto
+       de um cache LRU de qualquer tamanho;
+     * a distribuição dos intervalos entre buscas repetidas de uma mesma
+       chave, para as ``amostra`` chaves buscadas mais recentemente.
+
+    É ativado com ``PostmonModel.rastreador = RastreadorAcessos()``.
+    """
+
+    def __init__(self, k=100, amostra=100000):
+        self.k = k
+        self.amostra = amostra
+        self.total = 0
+        self._contagens = {}
+        # chaves agrupadas pela contagem e a menor contagem da tabela
+        self._grupos = {}
+        self._minimo = 0
+        self._recentes = deque(maxlen=amostra)
+        self._vistas = OrderedDict()
+        self._intervalos = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, chave, agora=None):
+        """Registra uma busca da ``chave``."""
+        if agora is None:
+            agora = time.time()
+        with self._lock:
+            self.total += 1
+            self._recentes.append(chave)
+
+            contagem = self._contagens.get(chave)
+            if contagem is not None:
+                self._mover(chave, contagem[0])
+                contagem[0] += 1
+            elif len(self._contagens) < self.k:
+                self._contagens[chave] = [1, 0]
+                self._grupos.setdefault(1, set()).add(chave)
+                self._minimo = 1
+            else:
+                n = self._minimo
+                menor = self._grupos[n].pop()
+                del self._contagens[menor]
+                self._contagens[chave] = [n + 1, n]
+                self._grupos[n].add(chave)
+                self._mover(chave, n)
+
+            anterior = self._vistas.pop(chave, None)
+            if anterior is not None:
+                limite = _limite_intervalo(agora - anterior)
+                self._intervalos[limite] = self._intervalos.get(limite, 0) + 1
+            self._vistas[chave] = agora
+            if len(self._vistas) > self.amostra:
+                self._vistas.popitem(last=False)
+
+    def _mover(self, chave, contagem):
+        """Move a ``chave`` do grupo ``contagem`` para o seguinte."""
+        grupo = self._grupos[contagem]
+        grupo.discard(chave)
+        if not grupo:
+            del self._grupos[contagem]
+            if contagem == self._minimo:
+                # as demais chaves têm contagem maior que a removida
+                self._minimo = contagem + 1
+        self._grupos.setdefault(contagem + 1, set()).add(chave)
+
+    def mais_buscadas(self, n=None):
+        """Retorna as ``n`` chaves mais buscadas (por padrão, todas as ``k``
+        monitoradas) como tuplas ``(chave, contagem, erro)``, da mais para a
+        menos buscada.
+
+        A contagem real de cada chave está entre ``contagem - erro`` e
+        ``contagem``.
+        """
+        with self._lock:
+            itens = [(chave, c[0], c[1])
+                     for chave, c in self._contagens.items()]
+        itens.sort(key=lambda item: (-item[1], item[0]))
+        return itens[:n] if n is not None else itens
+
+    def taxa_acerto(self, tamanho):
+        """Retorna a taxa de acerto, entre 0 e 1, que um cache LRU com
+        ``tamanho`` itens teria nas últimas ``amostra`` buscas, começando
+        vazio."""
+        with self._lock:
+            recentes = list(self._recentes)
+        if not recentes or tamanho <= 0:
+            return 0.0
+        cache = OrderedDict()
+        acertos = 0
+        for chave in recentes:
+            if chave in cache:
+                acertos += 1
+                del cache[chave]
+            elif len(cache) >= tamanho:
+                cache.popitem(last=False)
+            cache[chave] = True
+        return float(acertos) / len(recentes)
+
+    def intervalos(self):
+        """Retorna a distribuição dos intervalos entre buscas repetidas, como
+        uma lista de tuplas ``(limite, quantidade)``, onde ``quantidade`` é o
+        número de intervalos de até ``limite`` segundos (e maiores que o
+        limite anterior)."""
+        with self._lock:
+            return sorted(self._intervalos.items())
+
+    def exportar_prewarm(self, n=None):
+        """Retorna as chaves mais buscadas, que podem ser passadas para o
+        ``preaquecer()`` ao iniciar um novo processo.
+
+        Cada chave, somada ao ``base_url``, é a chave usada no
+        ``PostmonModel.cache``, então o ``preaquecer()`` preenche exatamente
+        as entradas que as buscas registradas vão consultar.
+        """
+        return [chave for chave, _, _ in self.mais_buscadas(n)]
+
+
+def _limite_intervalo(segundos):
+    """Arredonda o intervalo para cima, para a potência de 2 mais próxima,
+    a partir de 1/1024 s.
+
+    >>> _limite_intervalo(3), _limite_intervalo(0)
+    (4, 0.0009765625)
+    """
+    if segundos <= 2 ** -10:
+        return 2 ** -10
+    return 2 ** int(math.ceil(math.log(segundos, 2)))
+
+
+def preaquecer(chaves):
+    """Busca os objetos das ``chaves`` exportadas pelo
+    ``RastreadorAcessos.exportar_prewarm()``, com prioridade ``LOTE``,
+    para preencher o ``PostmonModel.cache``.
+
+    Retorna o número de buscas bem sucedidas.
+    """
+    sucessos = 0
+    for chave in chaves:
+        obj = _objeto_do_caminho(chave)
+        if obj is None:
+            logger.warning("chave desconhecida: %r" % chave)
+        elif obj.buscar(prioridade=LOTE):
+            sucessos += 1
+    return sucessos
+
+
+class TransporteRequests(object):
+    """Transporte que faz as requisições com o ``requests``.
+
+    Com ``sessoes=True``, as conexões são reaproveitadas entre as requisições
+    por meio de ``requests.Session``. Como a ``Session`` não é thread-safe,
+    cada requisição usa uma sessão que nenhuma outra thread está usando; ao
+    final, a sessão volta para uma lista de sessões livres.
+
+    Todo transporte tem um método ``get(url, headers, timeout=None)``, que
+    retorna um objeto com ``status_code``, ``reason``, ``ok``, ``content`` e
+    ``json()``, como o ``requests.Response``, e levanta
+    ``requests.RequestException`` em caso de falha de comunicação ou se a
+    resposta demorar mais que ``timeout`` segundos.
+    """
+
+    def __init__(self, sessoes=False):
+        self.sessoes = sessoes
+        self._livres = []
+        self._lock = threading.Lock()
+
+    def get(self, url, headers, timeout=None):
+        kwargs = {'headers': headers}
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        if not self.sessoes:
+            return requests.get(url, **kwargs)
+        with self._lock:
+            sessao = self._livres.pop() if self._livres else None
+        if sessao is None:
+            sessao = requests.Session()
+        try:
+            return sessao.get(url, **kwargs)
+        finally:
+            with self._lock:
+                self._livres.append(sessao)
+
+    def __getstate__(self):
+        # as sessões e as suas conexões não são copiadas
+        return {'sessoes': self.sessoes}
+
+    def __setstate__(self, estado):
+        self.__init__(**estado)
+
+
+_TRANSPORTE_PADRAO = TransporteRequests()
+
+
+class TransporteHttp2(object):
+    """Transporte que multiplexa as requisições em poucas conexões HTTP/2,
+    usando o ``httpx`` (``pip install postmon[http2]``).
+
+    São abertas até ``conexoes`` conexões, com até ``streams`` requisições
+    simultâneas em cada uma; acima disso, as requisições esperam por um
+    stream livre.
+
+    O HTTP/2 só é usado com HTTPS. Para URLs ``http://``, quando o pacote
+    ``h2`` não está instalado ou depois que um servidor HTTPS não negociar
+    HTTP/2, as requisições são feitas em HTTP/1.1, com até
+    ``conexoes * streams`` conexões, para manter o mesmo número de
+    requisições simultâneas.
+
+    Cada processo cria os seus próprios clientes, e as cópias feitas com
+    ``pickle`` não levam as conexões, então o transporte também pode ser
+    usado pelo ``enderecos()``::
+
+        postmon.PostmonModel.base_url = 'https://api.postmon.com.br/v1'
+        postmon.PostmonModel.transporte = postmon.TransporteHttp2()
+        postmon.enderecos(ceps, concorrencia=50)
+    """
+
+    def __init__(self, conexoes=2, streams=100, timeout=10.0):
+        if httpx is None:
+            raise ImportError('o TransporteHttp2 depende do httpx: '
+                              'pip install postmon[http2]')
+        self.conexoes = conexoes
+        self.streams = streams
+        self.timeout = timeout
+        self._streams = threading.BoundedSemaphore(conexoes * streams)
+        self._lock = threading.Lock()
+        # clientes do processo, indexados por usarem ou não HTTP/2
+        self._clientes = {}
+        self._pid = None
+        self._http2 = True
+
+    def get(self, url, headers, timeout=None):
+        http2 = self._http2 and url.startswith('https:')
+        cliente = self._cliente_do_processo(http2)
+        kwargs = {'headers': headers}
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        with self._streams:
+            try:
+                resposta = cliente.get(url, **kwargs)
+            except httpx.TimeoutException as e:
+                raise requests.Timeout(e)
+            except httpx.HTTPError as e:
+                raise requests.ConnectionError(e)
+        if http2 and resposta.http_version != 'HTTP/2':
+            self._sem_http2('o servidor não negociou HTTP/2')
+        return RespostaHttpx(resposta)
+
+    def fechar(self):
+        """Fecha as conexões abertas."""
+        with self._lock:
+            if self._pid == os.getpid():
+                for cliente in self._clientes.values():
+                    cliente.close()
+            self._clientes = {}
+
+    def __getstate__(self):
+        # os clientes e as suas conexões não são copiados
+        return {'conexoes': self.conexoes, 'streams': self.streams,
+                'timeout': self.timeout}
+
+    def __setstate__(self, estado):
+        self.__init__(**estado)
+
+    def _cliente_do_processo(self, http2=False):
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                self._clientes = {}
+                self._pid = pid
+            cliente = self._clientes.get(http2)
+            if cliente is None:
+                cliente = self._clientes[http2] = self._criar_cliente(http2)
+        return cliente
+
+    def _criar_cliente(self, http2):
+        if http2:
+            limites = httpx.Limits(max_connections=self.conexoes,
+                                   max_keepalive_connections=self.conexoes)
+            try:
+                return httpx.Client(http2=True, limits=limites,
+                                    timeout=self.timeout)
+            except ImportError:
+                self._sem_http2('pacote h2 não instalado')
+        # sem multiplexação, cada requisição simultânea precisa de uma conexão
+        maximo = self.conexoes * self.streams
+        limites = httpx.Limits(max_connections=maximo,
+                               max_keepalive_connections=maximo)
+        return httpx.Client(limits=limites, timeout=self.timeout)
+
+    def _sem_http2(self, motivo):
+        if self._http2:
+            self._http2 = False
+            logger.warning("%s, usando até %d conexões HTTP/1.1" %
+                           (motivo, self.conexoes * self.streams))
+
+
+class RespostaHttpx(object):
+    """Resposta recebida pelo ``TransporteHttp2``."""
+
+    def __init__(self, resposta):
+        self.status_code = resposta.status_code
+        self.reason = resposta.reason_phrase
+        self.content = resposta.content
+        self.ok = resposta.status_code < 400
+        #: versão do HTTP negociada, como ``'HTTP/2'`` ou ``'HTTP/1.1'``
+        self.http_version = resposta.http_version
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class TransporteGravador(object):
+    """Transporte que grava as respostas recebidas em um cassete, que depois
+    pode ser reproduzido pelo ``TransporteReplay``.
+
+    As requisições são feitas pelo ``transporte`` informado (por padrão, o
+    ``requests``). O cassete só é escrito no arquivo ao chamar ``salvar()``::
+
+        gravador = postmon.TransporteGravador('postmon.cassete')
+        postmon.PostmonModel.transporte = gravador
+        postmon.endereco('01419101')
+        gravador.salvar()
+    """
+
+    def __init__(self, caminho, transporte=None):
+        self.caminho = caminho
+        self.transporte = transporte or _TRANSPORTE_PADRAO
+        self.respostas = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, headers, timeout=None):
+        inicio = time.time()
+        resposta = self.transporte.get(url, headers, timeout)
+        latencia = time.time() - inicio
+        with self._lock:
+            self.respostas[url] = (resposta.status_code, resposta.reason,
+                                   resposta.content.decode('utf-8'),
+                                   round(latencia, 6))
+        return resposta
+
+    def salvar(self):
+        """Escreve as respostas gravadas no cassete."""
+        with self._lock:
+            cassete = {'versao': _CASSETE_VERSAO,
+                       'respostas': dict(self.respostas)}
+        with gzip.open(self.caminho, 'wb') as f:
+            f.write(json.dumps(cassete, separators=(',', ':')).encode('utf-8'))
+
+
+class TransporteReplay(object):
+    """Transporte que reproduz as respostas de um cassete, sem acessar a
+    rede.
+
+    ``cassete`` é o caminho de um arquivo gravado pelo ``TransporteGravador``
+    ou um dicionário ``{url: (status_code, reason, corpo)}``. URLs que não
+    estão no cassete falham com ``requests.ConnectionError``.
+
+    ``latencia`` define quanto tempo cada resposta demora: um número fixo de
+    segundos, ``'gravada'`` para repetir a latência registrada na gravação ou
+    uma função sem argumentos que retorna a latência, como a criada por
+    ``latencia_lognormal()``. Respostas que demorariam mais que o ``timeout``
+    da requisição falham com ``requests.Timeout``.
+    """
+
+    def __init__(self, cassete, latencia=0):
+        if not isinstance(cassete, dict):
+            with gzip.open(cassete, 'rb') as f:
+                dados = json.loads(f.read().decode('utf-8'))
+            if dados.get('versao') != _CASSETE_VERSAO:
+                raise ValueError('versão de cassete não suportada: %r' %
+                                 dados.get('versao'))
+            cassete = dados['respostas']
+        self.respostas = dict((url, tuple(r)) for url, r in cassete.items())
+        self.latencia = latencia
+
+    def get(self, url, headers, timeout=None):
+        try:
+            resposta = self.respostas[url]
+        except KeyError:
+            raise requests.ConnectionError('URL fora do cassete: %s' % url)
+
+        if self.latencia == 'gravada':
+            latencia = resposta[3] if len(resposta) > 3 else 0
+        elif callable(self.latencia):
+            latencia = self.latencia()
+        else:
+            latencia = self.latencia
+        if timeout is not None and latencia > timeout:
+            time.sleep(timeout)
+            raise requests.Timeout('resposta levaria %.3fs' % latencia)
+        if latencia > 0:
+            time.sleep(latencia)
+        return RespostaGravada(*resposta[:3])
+
+
+_CASSETE_VERSAO = 1
+
+
+class RespostaGravada(object):
+    """Resposta reproduzida pelo ``TransporteReplay``."""
+
+    def __init__(self, status_code, reason, corpo):
+        self.status_code = status_code
+        self.reason = reason
+        self.content = corpo.encode('utf-8')
+        self.ok = status_code < 400
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+def latencia_lognormal(mediana, p99, semente=None):
+    """Retorna uma função que sorteia latências com distribuição log-normal,
+    com a ``mediana`` e o percentil 99 (``p99``) informados, em segundos.
+
+    A distribuição log-normal tem a cauda longa típica dos tempos de
+    resposta de serviços HTTP.
+
+        >>> f = latencia_lognormal(0.05, 0.5, semente=1)
+        >>> 0 < f() < 5
+        True
+    """
+    mu = math.log(mediana)
+    # 2.326 é o z-score do percentil 99 da distribuição normal
+    sigma = (math.log(p99) - mu) / 2.326
+    gerador = random.Random(semente)
+    return lambda: gerador.lognormvariate(mu, sigma)
+
+
+class ErroCache(Exception):
+    """Falha de comunicação com o backend de cache."""
+
+
+class Cache(object):
+    """Interface dos backends de cache usados pelo ``PostmonModel.cache``.
+
+    As chaves são as URLs buscadas, com o caminho normalizado (o CEP apenas com
+    dígitos e a UF em maiúsculas), e os valores são os dicionários retornados
+    pelo Postmon. Falhas do backend devem ser informadas com ``ErroCache``.
+    """
+
+    def get(self, chave):
+        """Retorna o valor da ``chave`` ou ``None`` se não existir."""
+        raise NotImplementedError
+
+    def set(self, chave, valor, ttl=None):
+        """Grava o valor da ``chave``, que expira em ``ttl`` segundos."""
+        raise NotImplementedError
+
+    def ttl(self, chave):
+        """Retorna o tempo de vida restante da ``chave``, em segundos.
+
+        Retorna ``None`` se a chave não existir ou não expirar.
+        """
+        raise NotImplementedError
+
+    def mget(self, chaves):
+        """Retorna uma lista com os valores das ``chaves``."""
+        return [self.get(chave) for chave in chaves]
+
+    def mset(self, valores, ttl=None):
+        """Grava todos os itens do dicionário ``valores``."""
+        for chave, valor in valores.items():
+            self.set(chave, valor, ttl)
+
+    def itens(self):
+        """Retorna uma lista de tuplas ``(chave, valor, expira_em)`` com os
+        itens válidos do cache, usada pelo ``exportar_snapshot()``.
+
+        ``expira_em`` é um timestamp absoluto ou ``None``.
+        """
+        raise NotImplementedError
+
+
+class CacheMemoria(Cache):
+    """Cache em memória, local ao processo.
+
+    Se ``maximo`` for informado, as chaves usadas há mais tempo são
+    descartadas quando o cache fica cheio.
+
+        >>> c = CacheMemoria()
+        >>> c.set('a', {'x': 1})
+        >>> c.mget(['a', 'b'])
+        [{'x': 1}, None]
+    """
+
+    def __init__(self, maximo=None):
+        self.maximo = maximo
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chave):
+        with self._lock:
+            return self._get(chave, time.time())
+
+    def _get(self, chave, agora):
+        try:
+            valor, expira_em = self._itens.pop(chave)
+        except KeyError:
+            return None
+        if expira_em is not None and expira_em <= agora:
+            return None
+        self._itens[chave] = valor, expira_em
+        return valor
+
+    def set(self, chave, valor, ttl=None):
+        expira_em = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._itens.pop(chave, None)
+            self._itens[chave] = valor, expira_em
+            if self.maximo is not None:
+                while len(self._itens) > self.maximo:
+                    self._itens.popitem(last=False)
+
+    def ttl(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+        if item is None or item[1] is None:
+            return None
+        restante = item[1] - time.time()
+        return restante if restante > 0 else None
+
+    def mget(self, chaves):
+        agora = time.time()
+        with self._lock:
+            return [self._get(chave, agora) for chave in chaves]
+
+    def itens(self):
+        agora = time.time()
+        with self._lock:
+            return [(chave, valor, expira_em)
+                    for chave, (valor, expira_em) in self._itens.items()
+                    if expira_em is None or expira_em > agora]
+
+    def __len__(self):
+        return len(self._itens)
+
+
+class CacheRedis(Cache):
+    """Cache compartilhado em um servidor que fala o protocolo do Redis.
+
+    Não depende de nenhum cliente Redis: os comandos são enviados diretamente
+    pelo socket. Os valores são gravados em JSON, com as chaves prefixadas por
+    ``prefixo``. O ``mget()`` e o ``mset()`` fazem uma única ida ao servidor.
+    Cada comando usa uma conexão que nenhuma outra thread está usando, então
+    um servidor lento não serializa as buscas; as conexões livres são
+    reaproveitadas.
+    O ``itens()`` permite exportar o cache compartilhado com o
+    ``exportar_snapshot()``.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, prefixo='postmon:',
+                 timeout=1.0):
+        self.endereco = (host, port)
+        self.db = db
+        self.prefixo = prefixo
+        self.timeout = timeout
+        # conexões livres; cada comando usa uma conexão só sua
+        self._livres = []
+        self._lock = threading.Lock()
+
+    def get(self, chave):
+        valor = self._executar([('GET', self._chave(chave))])[0]
+        return self._decodificar(valor)
+
+    def set(self, chave, valor, ttl=None):
+        comando = ['SET', self._chave(chave), json.dumps(valor)]
+        if ttl is not None:
+            comando += ['PX', int(ttl * 1000)]
+        self._executar([comando])
+
+    def ttl(self, chave):
+        restante = self._executar([('PTTL', self._chave(chave))])[0]
+        return restante / 1000.0 if restante >= 0 else None
+
+    def mget(self, chaves):
+        if not chaves:
+            return []
+        comando = ['MGET'] + [self._chave(c) for c in chaves]
+        return [self._decodificar(v) for v in self._executar([comando])[0]]
+
+    def mset(self, valores, ttl=None):
+        if not valores:
+            return
+        if ttl is None:
+            comando = ['MSET']
+            for chave, valor in valores.items():
+                comando += [self._chave(chave), json.dumps(valor)]
+            self._executar([comando])
+        else:
+            self._executar([['SET', self._chave(chave), json.dumps(valor),
+                             'PX', int(ttl * 1000)]
+                            for chave, valor in valores.items()])
+
+    def itens(self):
+        """Percorre as chaves com o ``prefixo`` usando ``SCAN``, lendo os
+        valores e a expiração de cada página com uma única ida ao servidor.
+
+        Chaves gravadas ou removidas durante a varredura podem ou não ser
+        incluídas.
+        """
+        padrao = re.sub(r'([*?\[\]\\])', r'\\\1', self.prefixo) + '*'
+        inicio = len(self.prefixo.encode('utf-8'))
+        itens = []
+        cursor = b'0'
+        while True:
+            cursor, chaves = self._executar(
+                [('SCAN', cursor, 'MATCH', padrao, 'COUNT', 1000)])[0]
+            if chaves:
+                respostas = self._executar([['MGET'] + chaves] +
+                                           [('PTTL', c) for c in chaves])
+                agora = time.time()
+                for chave, valor, restante in zip(chaves, respostas[0],
+                                                  respostas[1:]):
+                    if valor is None or restante == -2:
+                        # a chave expirou durante a varredura
+                        continue
+                    expira_em = None
+                    if restante >= 0:
+                        expira_em = agora + restante / 1000.0
+                    itens.append((chave[inicio:].decode('utf-8'),
+                                  self._decodificar(valor), expira_em))
+            if cursor == b'0':
+                return itens
+
+    def fechar(self):
+        """Fecha as conexões com o servidor que não estão em uso."""
+        with self._lock:
+            livres, self._livres = self._livres, []
+        for conexao in livres:
+            _fechar_conexao(conexao)
+
+    def _chave(self, chave):
+        return self.prefixo + chave
+
+    @staticmethod
+    def _decodificar(valor):
+        if valor is None:
+            return None
+        return json.loads(valor.decode('utf-8'))
+
+    def _executar(self, comandos):
+        """Envia os ``comandos`` em pipeline e retorna as respostas."""
+        dados = b''.join(_resp_comando(c) for c in comandos)
+        with self._lock:
+            conexao = self._livres.pop() if self._livres else None
+        try:
+            if conexao is None:
+                conexao = self._conectar()
+            conexao[0].sendall(dados)
+            respostas = [_resp_ler(conexao[1]) for _ in comandos]
+        except (socket.error, IOError, ValueError) as e:
+            if conexao is not None:
+                _fechar_conexao(conexao)
+            raise ErroCache('%s: %s' % (self.endereco, e))
+        with self._lock:
+            self._livres.append(conexao)
+        for resposta in respostas:
+            if isinstance(resposta, ErroCache):
+                raise resposta
+        return respostas
+
+    def _conectar(self):
+        """Abre uma conexão, retornada como ``(socket, arquivo)``."""
+        sock = socket.create_connection(self.endereco, self.timeout)
+        conexao = sock, sock.makefile('rb')
+        if self.db:
+            try:
+                sock.sendall(_resp_comando(('SELECT', self.db)))
+                resposta = _resp_ler(conexao[1])
+            except BaseException:
+                _fechar_conexao(conexao)
+                raise
+            if isinstance(resposta, ErroCache):
+                _fechar_conexao(conexao)
+                raise resposta
+        return conexao
+
+
+def _fechar_conexao(conexao):
+    sock, arquivo = conexao
+    arquivo.close()
+    sock.close()
+
+
+class CacheSnapshot(Cache):
+    """Cache carregado de um snapshot gerado pelo ``exportar_snapshot()``.
+
+    O arquivo é mapeado em memória e as chaves são procuradas por busca
+    binária no índice, então a carga não depende do tamanho do snapshot. O
+    snapshot é somente leitura: as gravações vão para ``cache`` (por padrão um
+    ``CacheMemoria``), que também é consultado antes do snapshot::
+
+        postmon.PostmonModel.cache = postmon.CacheSnapshot('postmon.snap')
+    """
+
+    def __init__(self, caminho, cache=None):
+        self.cache = cache if cache is not None else CacheMemoria()
+        with open(caminho, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        cabecalho = self._mmap[:_SNAPSHOT_CABECALHO.size]
+        if len(cabecalho) < _SNAPSHOT_CABECALHO.size:
+            raise ValueError('snapshot inválido: %s' % caminho)
+        magic, versao, self._total, self._indice = \
+            _SNAPSHOT_CABECALHO.unpack(cabecalho)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError('snapshot inválido: %s' % caminho)
+        if versao != _SNAPSHOT_VERSAO:
+            raise ValueError('versão de snapshot não suportada: %d' % versao)
+
+    def get(self, chave):
+        valor = self.cache.get(chave)
+        if valor is None:
+            item = self._procurar(chave)
+            if item is not None:
+                valor = item[0]
+        return valor
+
+    def set(self, chave, valor, ttl=None):
+        self.cache.set(chave, valor, ttl)
+
+    def ttl(self, chave):
+        if self.cache.get(chave) is not None:
+            return self.cache.ttl(chave)
+        item = self._procurar(chave)
+        if item is None or item[1] is None:
+            return None
+        return item[1] - time.time()
+
+    def mset(self, valores, ttl=None):
+        self.cache.mset(valores, ttl)
+
+    def itens(self):
+        itens = dict((chave, (valor, expira_em))
+                     for chave, valor, expira_em in self.cache.itens())
+        agora = time.time()
+        for i in range(self._total):
+            chave = self._chave(i).decode('utf-8')
+            if chave not in itens:
+                valor, expira_em = self._item(i)
+                if expira_em is None or expira_em > agora:
+                    itens[chave] = valor, expira_em
+        return [(chave, valor, expira_em)
+                for chave, (valor, expira_em) in itens.items()]
+
+    def fechar(self):
+        """Libera o mapeamento do arquivo."""
+        self._mmap.close()
+
+    def _registro(self, i):
+        inicio = self._indice + i * _SNAPSHOT_REGISTRO.size
+        return _SNAPSHOT_REGISTRO.unpack(
+            self._mmap[inicio:inicio + _SNAPSHOT_REGISTRO.size])
+
+    def _chave(self, i):
+        inicio, tamanho = self._registro(i)[:2]
+        return self._mmap[inicio:inicio + tamanho]
+
+    def _item(self, i):
+        inicio, tamanho, expira_em = self._registro(i)[2:]
+        valor = json.loads(self._mmap[inicio:inicio + tamanho].decode('utf-8'))
+        return valor, expira_em or None
+
+    def _procurar(self, chave):
+        chave = chave.encode('utf-8')
+        inicio, fim = 0, self._total
+        while inicio < fim:
+            meio = (inicio + fim) // 2
+            if self._chave(meio) < chave:
+                inicio = meio + 1
+            else:
+                fim = meio
+        if inicio == self._total or self._chave(inicio) != chave:
+            return None
+        valor, expira_em = self._item(inicio)
+        if expira_em is not None and expira_em <= time.time():
+            return None
+        return valor, expira_em
+
+
+# Formato do snapshot:
+#  - cabeçalho: magic, versão, número de itens e posição do índice;
+#  - chaves e valores (JSON em UTF-8), um depois do outro;
+#  - índice ordenado pela chave, com a posição e o tamanho da chave e do valor
+#    e o timestamp de expiração (0 quando o item não expira).
+_SNAPSHOT_MAGIC = b'PMSN'
+_SNAPSHOT_VERSAO = 1
+_SNAPSHOT_CABECALHO = struct.Struct('>4sHIQ')
+_SNAPSHOT_REGISTRO = struct.Struct('>QIQId')
+
+# o ``os.rename`` não substitui um arquivo existente no Windows
+_substituir = getattr(os, 'replace', os.rename)
+
+
+def exportar_snapshot(caminho, cache=None):
+    """Grava os itens válidos do ``cache`` (por padrão o
+    ``PostmonModel.cache``) em um snapshot binário, que pode ser carregado
+    com o ``CacheSnapshot``.
+
+    A expiração de cada item é preservada. O arquivo é escrito em um
+    temporário e renomeado, então um snapshot existente nunca fica pela
+    metade.
+
+    Retorna o número de itens gravados.
+    """
+    if cache is None:
+        cache = PostmonModel.cache
+    itens = sorted((chave.encode('utf-8'), valor, expira_em)
+                   for chave, valor, expira_em in cache.itens())
+
+    temporario = '%s.%d.tmp' % (caminho, os.getpid())
+    with open(temporario, 'wb') as f:
+        posicao = _SNAPSHOT_CABECALHO.size
+        f.write(b'\0' * posicao)
+        indice = []
+        for chave, valor, expira_em in itens:
+            valor = json.dumps(valor, separators=(',', ':')).encode('utf-8')
+            indice.append(_SNAPSHOT_REGISTRO.pack(
+                posicao, len(chave), posicao + len(chave), len(valor),
+                expira_em or 0))
+            f.write(chave)
+            f.write(valor)
+            posicao += len(chave) + len(valor)
+        f.write(b''.join(indice))
+        f.seek(0)
+        f.write(_SNAPSHOT_CABECALHO.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSAO,
+                                         len(itens), posicao))
+    _substituir(temporario, caminho)
+    return len(itens)
+
+
+def _resp_comando(args):
+    """Codifica um comando no protocolo do Redis (RESP)."""
+    partes = [('*%d\r\n' % len(args)).encode('ascii')]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        partes.append(('$%d\r\n' % len(arg)).encode('ascii'))
+        partes.append(arg)
+        partes.append(b'\r\n')
+    return b''.join(partes)
+
+
+def _resp_ler(arquivo):
+    """Lê uma resposta no protocolo do Redis (RESP).
+
+    Erros retornados pelo servidor são retornados como ``ErroCache``.
+    """
+    linha = arquivo.readline()
+    if not linha.endswith(b'\r\n'):
+        raise IOError('conexão encerrada pelo servidor')
+    tipo, valor = linha[:1], linha[1:-2]
+    if tipo == b'+':
+        return valor.decode('utf-8')
+    elif tipo == b'-':
+        return ErroCache(valor.decode('utf-8'))
+    elif tipo == b':':
+        return int(valor)
+    elif tipo == b'$':
+        tamanho = int(valor)
+        if tamanho < 0:
+            return None
+        dados = arquivo.read(tamanho + 2)
+        return dados[:-2]
+    elif tipo == b'*':
+        tamanho = int(valor)
+        if tamanho < 0:
+            return None
+        return [_resp_ler(arquivo) for _ in range(tamanho)]
+    raise ValueError('resposta inválida: %r' % linha)
+
+
+def _cache_mget(cache, chaves):
+    try:
+        return cache.mget(chaves)
+    except ErroCache:
+        logger.exception("falha ao ler o cache")
+        return [None] * len(chaves)
+
+
+def _cache_mset(cache, valores, ttl):
+    try:
+        cache.mset(valores, ttl)
+    except ErroCache:
+        logger.exception("falha ao gravar o cache")
+
+
+class _RespostaLocal(object):
+    """Resposta de uma busca atendida sem requisição, pelo cache ou por um
+    objeto desserializado, no lugar da resposta do ``requests``."""
+
+    status_code = 200
+    reason = 'OK'
+    ok = True
+
+    def __init__(self, dados=None):
+        self._dados = dados
+
+    def json(self):
+        return self._dados
+
+
+class ServidorPostmon(socketserver.ThreadingMixIn, HTTPServer):
+    """Servidor HTTP compatível com o Postmon, para ser usado como sidecar
+    por serviços em qualquer linguagem.
+
+    Atende as rotas ``/v1/cep/<cep>``, ``/v1/cidade/<uf>/<nome>`` e
+    ``/v1/uf/<uf>`` fazendo as buscas com esta biblioteca, então usa o
+    ``PostmonModel.cache`` e o ``PostmonModel.transporte`` configurados.
+    Requisições simultâneas para a mesma URL são atendidas por uma única
+    busca. A rota ``/stats`` retorna os contadores do servidor e do
+    ``postmon.contadores`` em JSON.
+
+    Cada requisição é atendida em uma thread. É iniciado pelo comando
+    ``postmon serve``.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, endereco=('127.0.0.1', 8080)):
+        HTTPServer.__init__(self, endereco, _ServidorHandler)
+        self.contadores = Contadores()
+        self._buscas = {}
+        self._lock = threading.Lock()
+
+    def buscar(self, obj):
+        """Busca o objeto, juntando buscas simultâneas para a mesma URL.
+
+        Retorna uma tupla ``(status_code, reason, corpo)``.
+        """
+        url = obj.url
+        with self._lock:
+            busca = self._buscas.get(url)
+            lider = busca is None
+            if lider:
+                busca = self._buscas[url] = _BuscaCompartilhada()
+        if not lider:
+            self.contadores.incrementar('coalescidas')
+            busca.pronta.wait()
+            return busca.resultado
+
+        try:
+            busca.resultado = self._buscar(obj)
+        finally:
+            with self._lock:
+                del self._buscas[url]
+            busca.pronta.set()
+        return busca.resultado
+
+    def _buscar(self, obj):
+        if obj.buscar():
+            corpo = json.dumps(obj._dados).encode('utf-8')
+            return 200, 'OK', corpo
+        if obj.status is None:
+            return 503, 'SERVICO INDISPONIVEL', b''
+        return obj.status[0], obj.status[1], b''
+
+    def estatisticas(self):
+        """Retorna os contadores do servidor (``servidor``) e das buscas
+        (``buscas``)."""
+        return {'servidor': self.contadores.valores(),
+                'buscas': contadores.valores()}
+
+
+class _BuscaCompartilhada(object):
+
+    def __init__(self):
+        self.pronta = threading.Event()
+        self.resultado = None
+
+
+class _ServidorHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = '%s/%s' % (__title__, __version__)
+
+    def do_GET(self):
+        self.server.contadores.incrementar('requisicoes')
+        caminho = self.path.split('?', 1)[0]
+        if caminho == '/stats':
+            corpo = json.dumps(self.server.estatisticas()).encode('utf-8')
+            return self._responder(200, 'OK', corpo)
+
+        obj = None
+        if caminho.startswith('/v1/'):
+            obj = _objeto_do_caminho(caminho[3:], decodificar=True)
+        if obj is None:
+            return self._responder(404, 'NAO ENCONTRADO', b'')
+
+        try:
+            resultado = self.server.buscar(obj)
+        except Exception:
+            logger.exception("falha ao atender GET %s" % self.path)
+            resultado = None
+        if resultado is None:
+            resultado = 500, 'ERRO INTERNO', b''
+        self._responder(*resultado)
+
+    def _responder(self, status, reason, corpo):
+        self.server.contadores.incrementar('status_%d' % status)
+        self.send_response(status, reason)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def log_message(self, formato, *args):
+        logger.debug(formato, *args)
+
+
+_CEP_VALIDO = re.compile(r'^\d{5}-?\d{3}$')
+_UF_VALIDA = re.compile(r'^[A-Za-z]{2}$')
+# qualquer nome sem barras e sem caracteres de controle, exceto '.' e '..'
+_NOME_VALIDO = re.compile(r'^(?!\.\.?$)[^/\\\x00-\x1f]+$')
+
+_ROTAS = [
+    (re.compile(r'^/cep/([^/]+)$'), Endereco, (_CEP_VALIDO,)),
+    (re.compile(r'^/cidade/([^/]+)/([^/]+)$'), Cidade,
+     (_UF_VALIDA, _NOME_VALIDO)),
+    (re.compile(r'^/uf/([^/]+)$'), Estado, (_UF_VALIDA,)),
+]
+
+
+def _objeto_do_caminho(caminho, decodificar=False):
+    """Cria o objeto correspondente ao caminho de um ``endpoint``, como
+    ``'/uf/MG'``, ou retorna ``None`` se o caminho não for reconhecido.
+
+    Os segmentos são validados depois de decodificados: o CEP deve ter 8
+    dígitos, a UF 2 letras e o nome da cidade não pode conter barras nem ser
+    ``'.'`` ou ``'..'``.
+
+    >>> _objeto_do_caminho('/cidade/MG/Belo Horizonte')
+    <Cidade 'Belo Horizonte'>
+    >>> _objeto_do_caminho('/cep/..%2Fuf%2FMG', decodificar=True) is None
+    True
+    """
+    for rota, cls, validos in _ROTAS:
+        m = rota.match(caminho)
+        if m:
+            args = m.groups()
+            if decodificar:
+                args = [unquote(arg) for arg in args]
+            for arg, valido in zip(args, validos):
+                if not valido.match(arg):
+                    return None
+            return cls(*args)
+    return None
+
+
+def main(argv=None):
+    """Ponto de entrada do comando ``postmon``.
+
+    ``postmon serve`` inicia um ``ServidorPostmon``. Com ``--snapshot``, o
+    cache é carregado de um snapshot gerado pelo ``exportar_snapshot()``.
+    """
+    parser = argparse.ArgumentParser(prog='postmon')
+    comandos = parser.add_subparsers(dest='comando')
+    serve = comandos.add_parser(
+        'serve', help='inicia um servidor HTTP compatível com o Postmon')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8080)
+    serve.add_argument('--base-url', default=PostmonModel.base_url,
+                       help='URL do Postmon usado nas buscas')
+    serve.add_argument('--cache-maximo', type=int, default=100000,
+                       help='número máximo de itens no cache em memória')
+    serve.add_argument('--cache-ttl', type=float, default=None,
+                       help='tempo de vida dos itens no cache, em segundos')
+    serve.add_argument('--snapshot', help='snapshot usado como cache')
+    args = parser.parse_args(argv)
+    if args.comando != 'serve':
+        parser.print_help()
+        return 2
+
+    logging.basicConfig(level=logging.INFO)
+    PostmonModel.base_url = args.base_url
+    PostmonModel.cache_ttl = args.cache_ttl
+    PostmonModel.cache = CacheMemoria(args.cache_maximo)
+    if args.snapshot:
+        PostmonModel.cache = CacheSnapshot(args.snapshot, PostmonModel.cache)
+    if PostmonModel.transporte is None:
+        PostmonModel.transporte = TransporteRequests(sessoes=True)
+
+    servidor = ServidorPostmon((args.host, args.port))
+    logger.info("servindo em http://%s:%d/v1" % servidor.server_address[:2])
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+    return 0
+
+
+# respostas do Postmon usadas pelos doctests
 # TODO: isso é código de testes, não deveria estar nesse arquivo
 
 def setup():
-    import json
-    import httpretty
-    httpretty.enable()
+    respostas = {}
     url = '%s/cep/11111-111' % PostmonModel.base_url
     response = {
         "bairro": "Floresta",
@@ -324,7 +2683,7 @@ def setup():
         "cep": "11111-111",
         "estado": "MG"
     }
-    httpretty.register_uri(httpretty.GET, url, body=json.dumps(response))
+    respostas[url] = (200, 'OK', json.dumps(response))
 
     url = '%s/cidade/MG/Belo Horizonte' % PostmonModel.base_url
     response = {
@@ -332,7 +2691,7 @@ def setup():
         "codigo_ibge": "31",
         "nome": "Minas Gerais"
     }
-    httpretty.register_uri(httpretty.GET, url, body=json.dumps(response))
+    respostas[url] = (200, 'OK', json.dumps(response))
 
     url = '%s/uf/MG' % PostmonModel.base_url
     response = {
@@ -340,9 +2699,13 @@ def setup():
         "codigo_ibge": "31",
         "nome": "Minas Gerais"
     }
-    httpretty.register_uri(httpretty.GET, url, body=json.dumps(response))
+    respostas[url] = (200, 'OK', json.dumps(response))
+    PostmonModel.transporte = TransporteReplay(respostas)
 
 
 def teardown():
-    import httpretty
-    httpretty.disable()
+    PostmonModel.transporte = None
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,6 +23,15 @@ setup(
         'requests>=1.0',
     ],
 
+    entry_points={
+        'console_scripts': ['postmon = postmon:main'],
+    },
+
+    extras_require={
+        'http2': ['httpx[http2]'],
+        'msgpack': ['msgpack'],
+    },
+
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
@@ -1,7 +1,26 @@
+# coding: utf-8
 import unittest
+import gzip
 import json
+import multiprocessing
+import os
+import pickle
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
 from decimal import Decimal
 
+try:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
 import mock
 import httpretty
 import requests
@@ -297,3 +316,1766 @@ class TestRequestClient(unittest.TestCase):
         e.buscar()
         ua = e._response.request.headers['User-Agent'].split()
         self.assertEqual(postmon.PostmonModel.base_user_agent, ua[0])
+
+
+class TestEnderecos(unittest.TestCase):
+
+    ceps = ['30130-000', '01419101', '30140000', '99999999']
+
+    def setUp(self):
+        httpretty.enable()
+        for cep in self.ceps[:3]:
+            response = {"cep": cep, "cidade": "Cidade C", "estado": "MG"}
+            url = '%s/cep/%s' % (BASE_URL, cep)
+            httpretty.register_uri(httpretty.GET, url,
+                                   body=json.dumps(response))
+        httpretty.register_uri(httpretty.GET, '%s/cep/99999999' % BASE_URL,
+                               status=404)
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def test_particionar_por_prefixo(self):
+        lotes = postmon._particionar(self.ceps, 2, 500)
+        self.assertEqual([([1], ['01419101']),
+                          ([0, 2], ['30130-000', '30140000']),
+                          ([3], ['99999999'])], lotes)
+
+    def test_particionar_tamanho_lote(self):
+        lotes = postmon._particionar(self.ceps, 1, 1)
+        self.assertEqual([[1], [0], [2], [3]], [i for i, _ in lotes])
+
+    def test_resultado_em_ordem(self):
+        r = postmon.enderecos(self.ceps, processos=2, tamanho_lote=1)
+        self.assertEqual(['30130-000', '01419101', '30140000'],
+                         [e.cep for e in r[:3]])
+        self.assertTrue(r[3] is None)
+
+    def test_progresso(self):
+        chamadas = []
+        postmon.enderecos(self.ceps, processos=2, tamanho_lote=1,
+                          progresso=lambda *a: chamadas.append(a))
+        self.assertEqual([(1, 4), (2, 4), (3, 4), (4, 4)], chamadas)
+
+    def test_vazio(self):
+        self.assertEqual([], postmon.enderecos([]))
+
+
+class TestBuscarLote(unittest.TestCase):
+
+    def tearDown(self):
+        postmon.PostmonModel.transporte = None
+
+    def test_dados_decodificados_uma_vez(self):
+        response = {"cep": "11111111", "cidade": "Cidade C", "estado": "MG"}
+        postmon.PostmonModel.transporte = postmon.TransporteReplay({
+            '%s/cep/11111111' % BASE_URL: (200, 'OK', json.dumps(response))})
+        json_ = postmon.RespostaGravada.json
+        with mock.patch.object(postmon.RespostaGravada, 'json',
+                               autospec=True, side_effect=json_) as m:
+            indices, enderecos, dados = postmon._buscar_lote(
+                ([0, 1], ['11111111', '22222222']), postmon.LOTE, True)
+        self.assertEqual(1, m.call_count)
+        self.assertEqual({'%s/cep/11111111' % BASE_URL: response}, dados)
+        self.assertEqual([None], enderecos[1:])
+        # os dados decodificados não vão para o processo principal
+        self.assertFalse('_dados' in pickle.loads(
+            pickle.dumps(enderecos[0])).__dict__)
+
+
+class TestEnderecosSemFork(unittest.TestCase):
+
+    @unittest.skipIf(not hasattr(multiprocessing, 'get_all_start_methods') or
+                     'forkserver' not in
+                     multiprocessing.get_all_start_methods(),
+                     'forkserver não disponível')
+    def test_configuracao_sem_fork(self):
+        metodo = multiprocessing.get_start_method()
+        response = {"cep": "11111111", "cidade": "Cidade C", "estado": "MG"}
+        postmon.PostmonModel.base_url = 'http://replay/v1'
+        postmon.PostmonModel.transporte = postmon.TransporteReplay({
+            'http://replay/v1/cep/11111111': (200, 'OK',
+                                              json.dumps(response))})
+        multiprocessing.set_start_method('forkserver', force=True)
+        try:
+            r = postmon.enderecos(['11111111'], processos=1)
+        finally:
+            multiprocessing.set_start_method(metodo, force=True)
+            postmon.PostmonModel.base_url = BASE_URL
+            postmon.PostmonModel.transporte = None
+        self.assertEqual('Cidade C', r[0].cidade.nome)
+
+    @mock.patch('postmon._metodo_inicio', return_value='spawn')
+    def test_configuracao_sem_pickle(self, _):
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(
+            {}, latencia=lambda: 0)
+        try:
+            self.assertRaises(ValueError, postmon.enderecos, ['11111111'])
+        finally:
+            postmon.PostmonModel.transporte = None
+
+
+class TestCacheMemoria(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = postmon.CacheMemoria()
+
+    def test_get_inexistente(self):
+        self.assertTrue(self.cache.get('a') is None)
+
+    def test_set_get(self):
+        self.cache.set('a', {'x': 1})
+        self.assertEqual({'x': 1}, self.cache.get('a'))
+
+    def test_ttl(self):
+        self.cache.set('a', 1, ttl=60)
+        self.assertTrue(59 < self.cache.ttl('a') <= 60)
+        self.cache.set('b', 1)
+        self.assertTrue(self.cache.ttl('b') is None)
+
+    def test_expirado(self):
+        self.cache.set('a', 1, ttl=-1)
+        self.assertTrue(self.cache.get('a') is None)
+        self.assertTrue(self.cache.ttl('a') is None)
+
+    def test_mget(self):
+        self.cache.mset({'a': 1, 'b': 2})
+        self.assertEqual([1, None, 2], self.cache.mget(['a', 'c', 'b']))
+
+    def test_maximo(self):
+        cache = postmon.CacheMemoria(maximo=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual([1, None, 3], cache.mget(['a', 'b', 'c']))
+
+
+class _RedisFalso(socketserver.ThreadingTCPServer):
+    """Servidor que entende o subconjunto do protocolo do Redis usado pelo
+    ``CacheRedis``."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 _RedisFalsoHandler)
+        self.dados = {}
+        self.comandos = []
+
+
+class _RedisFalsoHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                comando = postmon._resp_ler(self.rfile)
+            except IOError:
+                return
+            nome = comando[0].decode().upper()
+            args = comando[1:]
+            self.server.comandos.append(nome)
+            self.wfile.write(getattr(self, 'cmd_' + nome)(*args))
+
+    def bulk(self, valor):
+        if valor is None:
+            return b'$-1\r\n'
+        return ('$%d\r\n' % len(valor)).encode() + valor + b'\r\n'
+
+    def get_valor(self, chave):
+        valor, expira_em = self.server.dados.get(chave, (None, None))
+        if expira_em is not None and expira_em <= time.time():
+            return None
+        return valor
+
+    def cmd_GET(self, chave):
+        if chave.endswith(b':lento'):
+            time.sleep(0.3)
+        return self.bulk(self.get_valor(chave))
+
+    def cmd_SET(self, chave, valor, px=None, ms=None):
+        expira_em = time.time() + int(ms) / 1000.0 if px else None
+        self.server.dados[chave] = valor, expira_em
+        return b'+OK\r\n'
+
+    def cmd_MSET(self, *args):
+        for chave, valor in zip(args[::2], args[1::2]):
+            self.server.dados[chave] = valor, None
+        return b'+OK\r\n'
+
+    def cmd_MGET(self, *chaves):
+        return (('*%d\r\n' % len(chaves)).encode() +
+                b''.join(self.bulk(self.get_valor(c)) for c in chaves))
+
+    def cmd_PTTL(self, chave):
+        valor, expira_em = self.server.dados.get(chave, (None, None))
+        if valor is None:
+            return b':-2\r\n'
+        if expira_em is None:
+            return b':-1\r\n'
+        return (':%d\r\n' % ((expira_em - time.time()) * 1000)).encode()
+
+    def cmd_SCAN(self, cursor, match, padrao, count, n):
+        # páginas de no máximo 2 chaves, para exercitar o cursor
+        prefixo = re.sub(br'\\(.)', br'\1', padrao[:-1])
+        chaves = sorted(c for c in self.server.dados if c.startswith(prefixo))
+        inicio, n = int(cursor), min(int(n), 2)
+        pagina = chaves[inicio:inicio + n]
+        proximo = inicio + n if inicio + n < len(chaves) else 0
+        return (b'*2\r\n' + self.bulk(str(proximo).encode()) +
+                ('*%d\r\n' % len(pagina)).encode() +
+                b''.join(self.bulk(c) for c in pagina))
+
+    def cmd_SELECT(self, db):
+        return b'-ERR DB index is out of range\r\n'
+
+
+class TestCacheRedis(unittest.TestCase):
+
+    def setUp(self):
+        self.servidor = _RedisFalso()
+        t = threading.Thread(target=self.servidor.serve_forever,
+                             kwargs={'poll_interval': 0.01})
+        t.daemon = True
+        t.start()
+        self.cache = postmon.CacheRedis(*self.servidor.server_address)
+
+    def tearDown(self):
+        self.cache.fechar()
+        self.servidor.shutdown()
+        self.servidor.server_close()
+
+    def test_set_get(self):
+        self.cache.set('a', {'x': 1})
+        self.assertEqual({'x': 1}, self.cache.get('a'))
+        self.assertTrue(b'postmon:a' in self.servidor.dados)
+
+    def test_get_inexistente(self):
+        self.assertTrue(self.cache.get('a') is None)
+
+    def test_ttl(self):
+        self.cache.set('a', 1, ttl=60)
+        self.assertTrue(59 < self.cache.ttl('a') <= 60)
+        self.cache.set('b', 1)
+        self.assertTrue(self.cache.ttl('b') is None)
+        self.assertTrue(self.cache.ttl('c') is None)
+
+    def test_mget_uma_ida_ao_servidor(self):
+        self.cache.mset(dict(('k%d' % i, i) for i in range(100)))
+        chaves = ['k%d' % i for i in range(100)] + ['x']
+        self.assertEqual(list(range(100)) + [None], self.cache.mget(chaves))
+        self.assertEqual(['MSET', 'MGET'], self.servidor.comandos)
+
+    def test_mset_com_ttl(self):
+        self.cache.mset({'a': 1, 'b': 2}, ttl=60)
+        self.assertEqual([1, 2], self.cache.mget(['a', 'b']))
+        self.assertTrue(self.cache.ttl('b') > 59)
+
+    def test_itens(self):
+        self.cache.mset({'a': 1, 'b': 2, 'c': 3})
+        self.cache.set('d', 4, ttl=60)
+        self.servidor.dados[b'outro:e'] = b'5', None
+        itens = sorted(self.cache.itens())
+        self.assertEqual([('a', 1, None), ('b', 2, None), ('c', 3, None)],
+                         itens[:3])
+        chave, valor, expira_em = itens[3]
+        self.assertEqual(('d', 4), (chave, valor))
+        self.assertTrue(time.time() + 59 < expira_em <= time.time() + 60)
+        self.assertEqual(4, len(itens))
+
+    def test_itens_prefixo_com_curinga(self):
+        cache = postmon.CacheRedis(*self.servidor.server_address,
+                                   prefixo='p*[')
+        cache.set('a', 1)
+        self.cache.set('b', 2)
+        try:
+            self.assertEqual([('a', 1, None)], cache.itens())
+        finally:
+            cache.fechar()
+
+    def test_exportar_snapshot(self):
+        self.cache.mset({'a': 1, 'b': 2})
+        diretorio = tempfile.mkdtemp()
+        try:
+            caminho = os.path.join(diretorio, 'postmon.snap')
+            self.assertEqual(2, postmon.exportar_snapshot(caminho,
+                                                          self.cache))
+            # substitui o snapshot existente
+            self.assertEqual(2, postmon.exportar_snapshot(caminho,
+                                                          self.cache))
+            snapshot = postmon.CacheSnapshot(caminho)
+            self.assertEqual([1, 2], snapshot.mget(['a', 'b']))
+            snapshot.fechar()
+        finally:
+            shutil.rmtree(diretorio)
+
+    def test_servidor_lento_nao_bloqueia_outras_threads(self):
+        t = threading.Thread(target=self.cache.get, args=('lento',))
+        t.start()
+        time.sleep(0.05)
+        inicio = time.time()
+        self.cache.set('a', 1)
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertTrue(time.time() - inicio < 0.2)
+        t.join()
+        self.assertEqual(2, len(self.cache._livres))
+
+    def test_conexoes_reaproveitadas(self):
+        def usar(i):
+            for j in range(50):
+                self.cache.set('k%d' % i, j)
+                self.assertEqual(j, self.cache.get('k%d' % i))
+
+        _em_paralelo(usar)
+        self.assertTrue(1 <= len(self.cache._livres) <= 8)
+
+    def test_erro_do_servidor(self):
+        cache = postmon.CacheRedis(*self.servidor.server_address, db=1)
+        self.assertRaises(postmon.ErroCache, cache.get, 'a')
+
+    def test_servidor_fora(self):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+        cache = postmon.CacheRedis(*self.servidor.server_address)
+        self.assertRaises(postmon.ErroCache, cache.get, 'a')
+
+
+class TestBuscarComCache(unittest.TestCase):
+
+    url = '%s/uf/mg' % BASE_URL
+    # as chaves do cache usam o caminho normalizado
+    chave = '%s/uf/MG' % BASE_URL
+    response = {
+        "area_km2": "586.522,122",
+        "codigo_ibge": "31",
+        "nome": "Minas Gerais"
+    }
+
+    def setUp(self):
+        postmon.PostmonModel.cache = postmon.CacheMemoria()
+
+    def tearDown(self):
+        postmon.PostmonModel.cache = None
+
+    @httpretty.activate
+    def test_grava_no_cache(self):
+        httpretty.register_uri(httpretty.GET, self.url,
+                               body=json.dumps(self.response))
+        postmon.estado('mg')
+        self.assertEqual(self.response,
+                         postmon.PostmonModel.cache.get(self.chave))
+
+    def test_chave_normalizada(self):
+        response = {"cep": "11111111", "cidade": "Cidade C", "estado": "MG"}
+        transporte = postmon.PostmonModel.transporte = mock.Mock(
+            wraps=postmon.TransporteReplay({
+                '%s/cep/11111-111' % BASE_URL: (200, 'OK',
+                                                json.dumps(response))}))
+        try:
+            postmon.endereco('11111-111')
+            self.assertEqual('Cidade C',
+                             postmon.endereco('11111111').cidade.nome)
+        finally:
+            postmon.PostmonModel.transporte = None
+        self.assertEqual(1, len([c for c in transporte.get.call_args_list
+                                 if '/cep/' in c[0][0]]))
+        self.assertEqual(['%s/cep/11111111' % BASE_URL],
+                         [c for c, _, _ in postmon.PostmonModel.cache.itens()
+                          if '/cep/' in c])
+
+    @mock.patch('postmon.requests.get')
+    def test_le_do_cache(self, mock_get):
+        postmon.PostmonModel.cache.set(self.chave, self.response)
+        e = postmon.estado('mg')
+        self.assertEqual('Minas Gerais', e.nome)
+        self.assertEqual((200, 'OK'), e.status)
+        self.assertFalse(mock_get.called)
+
+    @httpretty.activate
+    def test_nao_grava_falha(self):
+        httpretty.register_uri(httpretty.GET, self.url, status=404)
+        postmon.estado('mg')
+        self.assertEqual(0, len(postmon.PostmonModel.cache))
+
+    @httpretty.activate
+    def test_erro_no_cache(self):
+        httpretty.register_uri(httpretty.GET, self.url,
+                               body=json.dumps(self.response))
+        cache = postmon.PostmonModel.cache = mock.Mock()
+        cache.get.side_effect = cache.set.side_effect = postmon.ErroCache
+        self.assertEqual('Minas Gerais', postmon.estado('mg').nome)
+
+    @httpretty.activate
+    def test_enderecos_mget(self):
+        cache = postmon.PostmonModel.cache
+        cache.set('%s/cep/11111111' % BASE_URL,
+                  {"cep": "11111111", "cidade": "Cidade C", "estado": "MG"})
+        response = {"cep": "22222222", "cidade": "Cidade D", "estado": "SP"}
+        httpretty.register_uri(httpretty.GET, '%s/cep/22222222' % BASE_URL,
+                               body=json.dumps(response))
+        with mock.patch.object(cache, 'mget', wraps=cache.mget) as mget:
+            r = postmon.enderecos(['11111111', '22222222'], processos=1)
+        self.assertEqual(1, mget.call_count)
+        self.assertEqual(['Cidade C', 'Cidade D'], [e.cidade.nome for e in r])
+        self.assertEqual(response, cache.get('%s/cep/22222222' % BASE_URL))
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.caminho = os.path.join(self.dir, 'postmon.snap')
+        self.cache = postmon.CacheMemoria()
+        self.cache.set('%s/uf/MG' % BASE_URL, {"nome": "Minas Gerais"})
+        self.cache.set('%s/uf/SP' % BASE_URL, {"nome": "S\u00e3o Paulo"},
+                       ttl=60)
+        self.cache.set('%s/uf/RJ' % BASE_URL, {"nome": "Rio"}, ttl=-1)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def carregar(self):
+        self.assertEqual(2, postmon.exportar_snapshot(self.caminho,
+                                                      self.cache))
+        snapshot = postmon.CacheSnapshot(self.caminho)
+        self.addCleanup(snapshot.fechar)
+        return snapshot
+
+    def test_get(self):
+        snapshot = self.carregar()
+        self.assertEqual({"nome": "Minas Gerais"},
+                         snapshot.get('%s/uf/MG' % BASE_URL))
+        self.assertEqual({"nome": "S\u00e3o Paulo"},
+                         snapshot.get('%s/uf/SP' % BASE_URL))
+
+    def test_expirados_nao_sao_exportados(self):
+        snapshot = self.carregar()
+        self.assertTrue(snapshot.get('%s/uf/RJ' % BASE_URL) is None)
+        self.assertTrue(snapshot.get('%s/uf/AC' % BASE_URL) is None)
+
+    def test_ttl_preservado(self):
+        snapshot = self.carregar()
+        self.assertTrue(59 < snapshot.ttl('%s/uf/SP' % BASE_URL) <= 60)
+        self.assertTrue(snapshot.ttl('%s/uf/MG' % BASE_URL) is None)
+
+    def test_expira_depois_de_carregado(self):
+        self.cache.set('%s/uf/RJ' % BASE_URL, {"nome": "Rio"}, ttl=60)
+        self.assertEqual(3, postmon.exportar_snapshot(self.caminho,
+                                                      self.cache))
+        snapshot = postmon.CacheSnapshot(self.caminho)
+        self.addCleanup(snapshot.fechar)
+        with mock.patch('postmon.time.time', return_value=time.time() + 61):
+            self.assertTrue(snapshot.get('%s/uf/RJ' % BASE_URL) is None)
+
+    def test_gravacao_vai_para_o_cache(self):
+        snapshot = self.carregar()
+        snapshot.set('%s/uf/AC' % BASE_URL, {"nome": "Acre"})
+        self.assertEqual({"nome": "Acre"},
+                         snapshot.cache.get('%s/uf/AC' % BASE_URL))
+        self.assertEqual(3, len(snapshot.itens()))
+
+    def test_reexportar(self):
+        snapshot = self.carregar()
+        snapshot.set('%s/uf/AC' % BASE_URL, {"nome": "Acre"})
+        self.assertEqual(3, postmon.exportar_snapshot(self.caminho, snapshot))
+
+    def test_vazio(self):
+        postmon.exportar_snapshot(self.caminho, postmon.CacheMemoria())
+        snapshot = postmon.CacheSnapshot(self.caminho)
+        self.addCleanup(snapshot.fechar)
+        self.assertTrue(snapshot.get('a') is None)
+
+    def test_arquivo_invalido(self):
+        with open(self.caminho, 'wb') as f:
+            f.write(b'x' * 100)
+        self.assertRaises(ValueError, postmon.CacheSnapshot, self.caminho)
+
+    def test_versao_invalida(self):
+        self.carregar()
+        with open(self.caminho, 'r+b') as f:
+            f.seek(4)
+            f.write(b'\0\x63')
+        self.assertRaises(ValueError, postmon.CacheSnapshot, self.caminho)
+
+
+class TestTransporteGravadorReplay(unittest.TestCase):
+
+    url = '%s/uf/mg' % BASE_URL
+    response = {
+        "area_km2": "586.522,122",
+        "codigo_ibge": "31",
+        "nome": "Minas Gerais"
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.caminho = os.path.join(self.dir, 'postmon.cassete')
+
+    def tearDown(self):
+        postmon.PostmonModel.transporte = None
+        shutil.rmtree(self.dir)
+
+    @httpretty.activate
+    def gravar(self):
+        httpretty.register_uri(httpretty.GET, self.url,
+                               body=json.dumps(self.response))
+        httpretty.register_uri(httpretty.GET, '%s/uf/xx' % BASE_URL,
+                               status=404)
+        gravador = postmon.TransporteGravador(self.caminho)
+        postmon.PostmonModel.transporte = gravador
+        postmon.estado('mg')
+        postmon.estado('xx')
+        gravador.salvar()
+
+    def test_replay(self):
+        self.gravar()
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(
+            self.caminho)
+        e = postmon.estado('mg')
+        self.assertEqual('Minas Gerais', e.nome)
+        self.assertEqual((200, 'OK'), e.status)
+        self.assertTrue(postmon.estado('xx') is None)
+
+    def test_url_fora_do_cassete(self):
+        postmon.PostmonModel.transporte = postmon.TransporteReplay({})
+        self.assertTrue(postmon.estado('mg') is None)
+
+    def test_cassete_dicionario(self):
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(
+            {self.url: (200, 'OK', json.dumps(self.response))})
+        self.assertEqual('31', postmon.estado('mg').codigo_ibge)
+
+    @mock.patch('postmon.time.sleep')
+    def test_latencia_fixa(self, sleep):
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(
+            {self.url: (200, 'OK', json.dumps(self.response))}, latencia=0.2)
+        postmon.estado('mg')
+        sleep.assert_called_once_with(0.2)
+
+    @mock.patch('postmon.time.sleep')
+    def test_latencia_gravada(self, sleep):
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(
+            {self.url: (200, 'OK', json.dumps(self.response), 0.3)},
+            latencia='gravada')
+        postmon.estado('mg')
+        sleep.assert_called_once_with(0.3)
+
+    @mock.patch('postmon.time.sleep')
+    def test_latencia_funcao(self, sleep):
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(
+            {self.url: (200, 'OK', json.dumps(self.response))},
+            latencia=lambda: 0.4)
+        postmon.estado('mg')
+        sleep.assert_called_once_with(0.4)
+
+    def test_versao_invalida(self):
+        with gzip.open(self.caminho, 'wb') as f:
+            f.write(b'{"versao": 99, "respostas": {}}')
+        self.assertRaises(ValueError, postmon.TransporteReplay, self.caminho)
+
+
+class TestLatenciaLognormal(unittest.TestCase):
+
+    def test_percentis(self):
+        f = postmon.latencia_lognormal(0.05, 0.5, semente=42)
+        amostras = sorted(f() for _ in range(10000))
+        self.assertAlmostEqual(0.05, amostras[5000], delta=0.005)
+        self.assertAlmostEqual(0.5, amostras[9900], delta=0.1)
+
+
+class TestPerfilar(unittest.TestCase):
+
+    url = '%s/cidade/mg/Belo Horizonte' % BASE_URL
+    response = {
+        "area_km2": "331,401",
+        "codigo_ibge": "3106200"
+    }
+
+    def setUp(self):
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(
+            {self.url: (200, 'OK', json.dumps(self.response)),
+             '%s/uf/xx' % BASE_URL: (404, 'NOT FOUND', '')})
+
+    def tearDown(self):
+        postmon.PostmonModel.transporte = None
+        postmon.PostmonModel.cache = None
+        postmon.PostmonModel.agendador = None
+
+    def test_fases(self):
+        with postmon.perfilar() as perfil:
+            postmon.cidade('mg', 'Belo Horizonte')
+            postmon.cidade('mg', 'Belo Horizonte')
+        fases = perfil.resumo()['Cidade.buscar']
+        self.assertEqual(set(['transporte', 'json', 'atualizar',
+                              'atualizar;area_km2', 'total']), set(fases))
+        self.assertEqual(2, fases['total']['n'])
+        for estatisticas in fases.values():
+            self.assertTrue(estatisticas['p50'] <= estatisticas['p99'] <=
+                            estatisticas['max'])
+
+    def test_fila(self):
+        agendador = postmon.PostmonModel.agendador = postmon.Agendador(
+            1, reservadas=0)
+        ocupada = threading.Event()
+
+        def ocupar():
+            with agendador.vaga():
+                ocupada.set()
+                time.sleep(0.1)
+
+        t = threading.Thread(target=ocupar)
+        t.start()
+        ocupada.wait()
+        with postmon.perfilar() as perfil:
+            postmon.cidade('mg', 'Belo Horizonte')
+        t.join()
+        fases = perfil.resumo()['Cidade.buscar']
+        self.assertTrue(fases['fila']['max'] >= 0.05)
+        self.assertTrue(fases['transporte']['max'] < 0.05)
+
+    def test_cache(self):
+        postmon.PostmonModel.cache = postmon.CacheMemoria()
+        with postmon.perfilar() as perfil:
+            postmon.cidade('mg', 'Belo Horizonte')
+            postmon.cidade('mg', 'Belo Horizonte')
+        fases = perfil.resumo()['Cidade.buscar']
+        self.assertEqual(2, fases['cache']['n'])
+        self.assertEqual(1, fases['transporte']['n'])
+        self.assertEqual(2, fases['atualizar']['n'])
+
+    def test_falha(self):
+        with postmon.perfilar() as perfil:
+            postmon.estado('xx')
+            postmon.estado('yy')
+        fases = perfil.resumo()['Estado.buscar']
+        self.assertEqual(set(['transporte', 'total']), set(fases))
+        self.assertEqual(2, fases['total']['n'])
+
+    def test_pilhas(self):
+        with postmon.perfilar() as perfil:
+            postmon.cidade('mg', 'Belo Horizonte')
+        pilhas = dict(linha.rsplit(' ', 1)
+                      for linha in perfil.pilhas().splitlines())
+        self.assertEqual(['Cidade.buscar;atualizar',
+                          'Cidade.buscar;atualizar;area_km2',
+                          'Cidade.buscar;json',
+                          'Cidade.buscar;transporte'], sorted(pilhas))
+        for valor in pilhas.values():
+            int(valor)
+
+    def test_desativado(self):
+        with postmon.perfilar() as perfil:
+            pass
+        postmon.cidade('mg', 'Belo Horizonte')
+        self.assertEqual({}, perfil.resumo())
+        self.assertEqual([], postmon._perfis)
+
+
+class TestEstatisticas(unittest.TestCase):
+
+    def test_percentis(self):
+        e = postmon._estatisticas([float(i) for i in range(1, 101)])
+        self.assertEqual(100, e['n'])
+        self.assertEqual(50.0, e['p50'])
+        self.assertEqual(90.0, e['p90'])
+        self.assertEqual(99.0, e['p99'])
+        self.assertEqual(100.0, e['max'])
+
+
+class _PostmonFalso(socketserver.ThreadingMixIn, HTTPServer):
+    """Servidor HTTP/1.1 local que responde como o Postmon."""
+
+    daemon_threads = True
+    # aceita várias conexões simultâneas sem descartar nenhuma
+    request_queue_size = 64
+    #: tempo que cada resposta demora, em segundos
+    latencia = 0
+
+    def __init__(self, respostas):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _PostmonFalsoHandler)
+        self.respostas = respostas
+        self.url = 'http://127.0.0.1:%d/v1' % self.server_address[1]
+
+
+class _PostmonFalsoHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.latencia)
+        resposta = self.server.respostas.get(self.path)
+        corpo = json.dumps(resposta).encode() if resposta else b''
+        self.send_response(200 if resposta else 404)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(postmon.httpx is None, 'httpx não instalado')
+class TestTransporteHttp2(unittest.TestCase):
+
+    response = {
+        "area_km2": "586.522,122",
+        "codigo_ibge": "31",
+        "nome": "Minas Gerais"
+    }
+
+    def setUp(self):
+        self.servidor = _PostmonFalso({'/v1/uf/mg': self.response})
+        t = threading.Thread(target=self.servidor.serve_forever,
+                             kwargs={'poll_interval': 0.01})
+        t.daemon = True
+        t.start()
+        self.transporte = postmon.TransporteHttp2(conexoes=1, streams=2)
+
+    def tearDown(self):
+        self.transporte.fechar()
+        self.servidor.shutdown()
+        self.servidor.server_close()
+
+    def test_fallback_http11(self):
+        resposta = self.transporte.get(self.servidor.url + '/uf/mg', {})
+        self.assertEqual('HTTP/1.1', resposta.http_version)
+        self.assertEqual(self.response, resposta.json())
+
+    def test_buscar(self):
+        e = postmon.Estado('mg')
+        e.base_url = self.servidor.url
+        e.transporte = self.transporte
+        self.assertTrue(e.buscar())
+        self.assertEqual('Minas Gerais', e.nome)
+        self.assertEqual((200, 'OK'), e.status)
+
+    def test_404(self):
+        e = postmon.Estado('xx')
+        e.base_url = self.servidor.url
+        e.transporte = self.transporte
+        self.assertFalse(e.buscar())
+        self.assertEqual(404, e.status[0])
+
+    def test_falha_de_conexao(self):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+        self.assertRaises(requests.RequestException, self.transporte.get,
+                          self.servidor.url + '/uf/mg', {})
+
+    def test_limite_de_streams(self):
+        ativas = []
+        maximo = []
+        lock = threading.Lock()
+
+        def get(url, headers):
+            with lock:
+                ativas.append(1)
+                maximo.append(len(ativas))
+            time.sleep(0.01)
+            with lock:
+                ativas.pop()
+            return mock.Mock(status_code=200, reason_phrase='OK',
+                             content=b'{}', http_version='HTTP/2')
+
+        cliente = mock.Mock(get=get)
+        with mock.patch.object(self.transporte, '_cliente_do_processo',
+                               return_value=cliente):
+            threads = [threading.Thread(target=self.transporte.get,
+                                        args=('url', {}))
+                       for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(2, max(maximo))
+
+    def test_http11_sem_limite_de_conexoes_http2(self):
+        transporte = postmon.TransporteHttp2(conexoes=1, streams=8)
+        self.servidor.latencia = 0.2
+        url = self.servidor.url + '/uf/mg'
+        inicio = time.time()
+        threads = [threading.Thread(target=transporte.get, args=(url, {}))
+                   for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        transporte.fechar()
+        # com uma única conexão, as 8 requisições levariam 1.6s
+        self.assertTrue(time.time() - inicio < 1.0)
+
+    def test_servidor_https_sem_http2(self):
+        resposta = mock.Mock(status_code=200, reason_phrase='OK',
+                             content=b'{}', http_version='HTTP/1.1')
+        cliente = mock.Mock(get=mock.Mock(return_value=resposta))
+        with mock.patch.object(self.transporte, '_cliente_do_processo',
+                               return_value=cliente) as cliente_do_processo:
+            self.transporte.get('https://postmon/v1/uf/mg', {})
+            self.transporte.get('https://postmon/v1/uf/mg', {})
+        self.assertEqual([mock.call(True), mock.call(False)],
+                         cliente_do_processo.call_args_list)
+
+    def test_pickle(self):
+        url = self.servidor.url + '/uf/mg'
+        self.transporte.get(url, {})
+        copia = pickle.loads(pickle.dumps(self.transporte))
+        self.assertEqual((1, 2), (copia.conexoes, copia.streams))
+        self.assertEqual({}, copia._clientes)
+        self.assertEqual(200, copia.get(url, {}).status_code)
+        copia.fechar()
+
+    def test_cliente_por_processo(self):
+        cliente = self.transporte._cliente_do_processo()
+        self.assertTrue(cliente is self.transporte._cliente_do_processo())
+        with mock.patch('postmon.os.getpid', return_value=-1):
+            self.assertFalse(cliente is
+                             self.transporte._cliente_do_processo())
+        cliente.close()
+
+
+class TestEnderecosConcorrencia(unittest.TestCase):
+
+    @httpretty.activate
+    def test_concorrencia(self):
+        ceps = ['%08d' % i for i in range(20)]
+        for cep in ceps:
+            response = {"cep": cep, "cidade": "Cidade C", "estado": "MG"}
+            httpretty.register_uri(httpretty.GET,
+                                   '%s/cep/%s' % (BASE_URL, cep),
+                                   body=json.dumps(response))
+        r = postmon.enderecos(ceps, processos=2, concorrencia=4)
+        self.assertEqual(ceps, [e.cep for e in r])
+
+
+def _em_paralelo(funcao, n_threads=8):
+    """Executa ``funcao(i)`` em ``n_threads`` threads, liberadas ao mesmo
+    tempo, e propaga a primeira exceção."""
+    largada = threading.Event()
+    erros = []
+
+    def executar(i):
+        largada.wait()
+        try:
+            funcao(i)
+        except Exception as e:
+            erros.append(e)
+
+    threads = [threading.Thread(target=executar, args=(i,))
+               for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    largada.set()
+    for t in threads:
+        t.join()
+    if erros:
+        raise erros[0]
+
+
+class TestConcorrencia(unittest.TestCase):
+    """Testes de estresse com várias threads."""
+
+    @classmethod
+    def setUpClass(cls):
+        # trocas de thread mais frequentes expõem mais condições de corrida
+        if hasattr(sys, 'setswitchinterval'):
+            cls.intervalo = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+
+    @classmethod
+    def tearDownClass(cls):
+        if hasattr(sys, 'setswitchinterval'):
+            sys.setswitchinterval(cls.intervalo)
+
+    def tearDown(self):
+        postmon.PostmonModel.transporte = None
+        postmon.PostmonModel.cache = None
+
+    def test_contadores(self):
+        c = postmon.Contadores()
+
+        def incrementar(i):
+            for _ in range(10000):
+                c.incrementar('a')
+                c.incrementar('b', 2)
+
+        _em_paralelo(incrementar)
+        self.assertEqual({'a': 80000, 'b': 160000}, c.valores())
+
+    def test_contadores_lidos_durante_incrementos(self):
+        c = postmon.Contadores()
+        leituras = []
+
+        def executar(i):
+            for _ in range(2000):
+                if i % 2:
+                    leituras.append(c.valores().get('a', 0))
+                else:
+                    c.incrementar('a')
+
+        _em_paralelo(executar)
+        self.assertEqual(8000, c.valores()['a'])
+        self.assertTrue(all(0 <= n <= 8000 for n in leituras))
+
+    def test_contadores_threads_encerradas(self):
+        c = postmon.Contadores()
+        for _ in range(50):
+            t = threading.Thread(target=c.incrementar, args=('buscas',))
+            t.start()
+            t.join()
+        self.assertTrue(len(c._threads) <= 1)
+        self.assertEqual({'buscas': 50}, c.valores())
+
+    def test_contadores_zerar(self):
+        c = postmon.Contadores()
+        _em_paralelo(lambda i: c.incrementar('a'))
+        c.zerar()
+        self.assertEqual({'a': 0}, c.valores())
+        c.incrementar('a')
+        self.assertEqual({'a': 1}, c.valores())
+
+    def test_cache_memoria(self):
+        cache = postmon.CacheMemoria(maximo=100)
+
+        def usar(i):
+            for j in range(2000):
+                chave = 'k%d' % (j % 150)
+                cache.set(chave, {'chave': chave, 'thread': i})
+                valor = cache.get(chave)
+                if valor is not None:
+                    self.assertEqual(chave, valor['chave'])
+                cache.mget(['k1', 'k2', 'k3'])
+                self.assertTrue(len(cache) <= 100)
+
+        _em_paralelo(usar)
+        self.assertEqual(100, len(cache))
+        for chave, valor, _ in cache.itens():
+            self.assertEqual(chave, valor['chave'])
+
+    def buscas(self):
+        respostas = {}
+        for i in range(200):
+            cep = '%08d' % i
+            response = {"cep": cep, "cidade": "Cidade %d" % i,
+                        "estado": "MG"}
+            respostas['%s/cep/%s' % (BASE_URL, cep)] = (
+                200, 'OK', json.dumps(response))
+        return respostas
+
+    def test_buscar(self):
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(
+            self.buscas())
+        postmon.PostmonModel.cache = postmon.CacheMemoria(maximo=50)
+        antes = postmon.contadores.valores().get('buscas', 0)
+
+        def buscar(i):
+            for j in range(200):
+                cep = '%08d' % ((i * 37 + j) % 200)
+                e = postmon.endereco(cep)
+                self.assertEqual(cep, e.cep)
+                self.assertEqual('Cidade %d' % int(cep), e.cidade.nome)
+
+        _em_paralelo(buscar)
+        self.assertEqual(1600,
+                         postmon.contadores.valores()['buscas'] - antes)
+
+    def test_gravador(self):
+        replay = postmon.TransporteReplay(self.buscas())
+        gravador = postmon.TransporteGravador(None, replay)
+        postmon.PostmonModel.transporte = gravador
+        _em_paralelo(lambda i: [postmon.endereco('%08d' % j)
+                                for j in range(i, 200, 8)])
+        self.assertEqual(200, len(gravador.respostas))
+
+    def test_transporte_requests_sessoes(self):
+        em_uso = set()
+        sessoes = set()
+        lock = threading.Lock()
+
+        class SessaoFalsa(object):
+            def __init__(self):
+                with lock:
+                    sessoes.add(self)
+
+            def get(sessao, url, **kwargs):
+                with lock:
+                    self.assertFalse(sessao in em_uso)
+                    em_uso.add(sessao)
+                time.sleep(0.001)
+                with lock:
+                    em_uso.remove(sessao)
+
+        transporte = postmon.TransporteRequests(sessoes=True)
+        with mock.patch('postmon.requests.Session', SessaoFalsa):
+            _em_paralelo(lambda i: [transporte.get('url', {})
+                                    for _ in range(50)])
+        self.assertTrue(1 <= len(sessoes) <= 8)
+
+    def test_perfil(self):
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(
+            self.buscas())
+        with postmon.perfilar() as perfil:
+            _em_paralelo(lambda i: [postmon.endereco('%08d' % j)
+                                    for j in range(100)])
+        self.assertEqual(800, perfil.resumo()['Endereco.buscar']['total']['n'])
+
+
+class TestCongelados(unittest.TestCase):
+
+    def setUp(self):
+        self.endereco = postmon.Endereco(
+            '11111-111', bairro='Bairro B', cidade='Cidade C', estado='SP',
+            cidade_info={"area_km2": "1099,409", "codigo_ibge": "3549904"},
+            estado_info={"nome": "Estado E", "codigo_ibge": "35"})
+
+    def test_endereco(self):
+        e = self.endereco.congelar()
+        self.assertEqual('11111-111', e.cep)
+        self.assertEqual('11111111', e.chave)
+        self.assertEqual('Bairro B', e.bairro)
+        self.assertEqual(Decimal('1099.409'), e.cidade.area_km2)
+        self.assertEqual('Estado E', e.estado.nome)
+
+    def test_endereco_sem_cidade(self):
+        e = postmon.Endereco('11111111').congelar()
+        self.assertTrue(e.cidade is None)
+        self.assertTrue(e.estado is None)
+
+    def test_imutavel(self):
+        e = self.endereco.congelar()
+        self.assertRaises(AttributeError, setattr, e, 'bairro', 'X')
+        self.assertRaises(AttributeError, setattr, e, 'novo', 'X')
+        self.assertRaises(AttributeError, delattr, e, 'bairro')
+
+    def test_deduplicacao(self):
+        enderecos = set([self.endereco.congelar(),
+                         postmon.EnderecoCongelado('11111111'),
+                         postmon.EnderecoCongelado('22222-222')])
+        self.assertEqual(2, len(enderecos))
+
+    def test_igualdade_entre_tipos(self):
+        e = postmon.EnderecoCongelado('35')
+        self.assertNotEqual(e, postmon.EstadoCongelado('35'))
+        self.assertNotEqual(e, '35')
+        self.assertTrue(e != postmon.EnderecoCongelado('36'))
+        self.assertFalse(e != postmon.EnderecoCongelado('35'))
+
+    def test_cidade(self):
+        a = self.endereco.cidade.congelar()
+        # a mesma cidade, de uma resposta sem ``cidade_info``
+        b = postmon.Endereco('22222222', cidade='Cidade C',
+                             estado='sp').cidade.congelar()
+        self.assertTrue(b.codigo_ibge is None)
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(1, len(set([a, b])))
+        self.assertNotEqual(a, postmon.CidadeCongelada(
+            'sp', 'Outro Nome', codigo_ibge='3549904'))
+        self.assertEqual('MG/Belo Horizonte',
+                         postmon.CidadeCongelada('mg', 'Belo Horizonte').chave)
+
+    def test_estado(self):
+        self.assertEqual(postmon.EstadoCongelado('sp'),
+                         self.endereco.estado.congelar())
+        self.assertEqual('SP', str(postmon.EstadoCongelado('sp')))
+
+    def test_chave_para_cruzamento(self):
+        clientes = {'11111111': 'cliente 1'}
+        e = self.endereco.congelar()
+        self.assertEqual('cliente 1', clientes[e.chave])
+
+    def test_pickle(self):
+        e = self.endereco.congelar()
+        copia = pickle.loads(pickle.dumps(e, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(e, copia)
+        self.assertEqual('Cidade C', copia.cidade.nome)
+
+
+class TestAgendador(unittest.TestCase):
+
+    def setUp(self):
+        self.agendador = postmon.Agendador(3, reservadas=1, max_fila=1,
+                                           timeout=0.05)
+        self.liberar = threading.Event()
+        self.threads = []
+
+    def tearDown(self):
+        self.liberar.set()
+        for t in self.threads:
+            t.join()
+        postmon.PostmonModel.agendador = None
+        postmon.PostmonModel.transporte = None
+
+    def ocupar(self, prioridade, n=1):
+        """Ocupa ``n`` vagas até o fim do teste."""
+        ocupadas = threading.Semaphore(0)
+
+        def ocupar():
+            with self.agendador.vaga(prioridade):
+                ocupadas.release()
+                self.liberar.wait()
+
+        for _ in range(n):
+            t = threading.Thread(target=ocupar)
+            t.start()
+            self.threads.append(t)
+        for _ in range(n):
+            ocupadas.acquire()
+
+    def esperar(self, condicao):
+        for _ in range(500):
+            if condicao(self.agendador.estado()):
+                return
+            time.sleep(0.001)
+        self.fail('estado esperado não alcançado')
+
+    def test_reservadas_para_interativas(self):
+        self.ocupar(postmon.LOTE, 2)
+        self.assertRaises(postmon.FilaCheia,
+                          self.agendador._adquirir_lote)
+        with self.agendador.vaga(postmon.INTERATIVA):
+            self.assertEqual({'em_uso': 3, 'lote': 2, 'fila': 0,
+                              'interativas': 0}, self.agendador.estado())
+
+    def test_interativas_usam_todas_as_vagas(self):
+        self.ocupar(postmon.INTERATIVA, 3)
+        self.assertEqual(3, self.agendador.estado()['em_uso'])
+
+    def test_fila_cheia(self):
+        self.agendador.timeout = None
+        self.ocupar(postmon.LOTE, 2)
+        t = threading.Thread(target=self.ocupar, args=(postmon.LOTE,))
+        t.start()
+        self.esperar(lambda e: e['fila'] == 1)
+        self.agendador.timeout = 0.05
+        inicio = time.time()
+        self.assertRaises(postmon.FilaCheia, self.agendador._adquirir_lote)
+        self.assertTrue(time.time() - inicio >= 0.05)
+        self.liberar.set()
+        t.join()
+
+    def test_interativas_tem_preferencia(self):
+        self.agendador.timeout = None
+        self.ocupar(postmon.INTERATIVA, 3)
+        ordem = []
+
+        def buscar(prioridade):
+            with self.agendador.vaga(prioridade):
+                ordem.append(prioridade)
+
+        lote = threading.Thread(target=buscar, args=(postmon.LOTE,))
+        lote.start()
+        self.esperar(lambda e: e['fila'] == 1)
+        interativa = threading.Thread(target=buscar,
+                                      args=(postmon.INTERATIVA,))
+        interativa.start()
+        self.esperar(lambda e: e['interativas'] == 1)
+        self.liberar.set()
+        lote.join()
+        interativa.join()
+        self.assertEqual([postmon.INTERATIVA, postmon.LOTE], ordem)
+
+    def test_reservadas_invalidas(self):
+        self.assertRaises(ValueError, postmon.Agendador, 2, reservadas=2)
+
+    def test_fila_cheia_retorna_none(self):
+        response = {"cep": "11111111", "cidade": "Cidade C", "estado": "MG"}
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(
+            {'%s/cep/11111111' % BASE_URL: (200, 'OK', json.dumps(response))})
+        postmon.PostmonModel.agendador = self.agendador
+        self.ocupar(postmon.LOTE, 2)
+        antes = postmon.contadores.valores().get('fila_cheia', 0)
+        self.assertTrue(postmon.endereco('11111111',
+                                         prioridade=postmon.LOTE) is None)
+        self.assertEqual([None, None],
+                         postmon.enderecos(['11111111', '22222222'],
+                                           processos=0))
+        self.assertEqual(3, postmon.contadores.valores()['fila_cheia'] -
+                         antes)
+        self.assertEqual('Cidade C',
+                         postmon.endereco('11111111').cidade.nome)
+
+    def test_buscar_usa_prioridade(self):
+        response = {"cep": "11111111", "cidade": "Cidade C", "estado": "MG"}
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(
+            {'%s/cep/11111111' % BASE_URL: (200, 'OK', json.dumps(response))})
+        agendador = postmon.PostmonModel.agendador = mock.MagicMock()
+        postmon.endereco('11111111')
+        postmon.endereco('11111111', prioridade=postmon.LOTE)
+        postmon.enderecos(['11111111'], processos=0)
+        self.assertEqual([mock.call(postmon.INTERATIVA),
+                          mock.call(postmon.LOTE),
+                          mock.call(postmon.LOTE)],
+                         agendador.vaga.call_args_list)
+
+
+class TestEnderecosNoProcesso(unittest.TestCase):
+
+    def tearDown(self):
+        postmon.PostmonModel.transporte = None
+        postmon.PostmonModel.cache = None
+
+    def test_em_threads(self):
+        respostas = {}
+        ceps = ['%08d' % i for i in range(50)]
+        for cep in ceps:
+            response = {"cep": cep, "cidade": "Cidade C", "estado": "MG"}
+            respostas['%s/cep/%s' % (BASE_URL, cep)] = (
+                200, 'OK', json.dumps(response))
+        postmon.PostmonModel.transporte = postmon.TransporteReplay(respostas)
+        postmon.PostmonModel.cache = postmon.CacheMemoria()
+        postmon.PostmonModel.agendador = postmon.Agendador(4, reservadas=1)
+        try:
+            r = postmon.enderecos(ceps + ['99999999'], processos=0,
+                                  concorrencia=4, tamanho_lote=5)
+        finally:
+            postmon.PostmonModel.agendador = None
+        self.assertEqual(ceps, [e.cep for e in r[:-1]])
+        self.assertTrue(r[-1] is None)
+        self.assertEqual(50, len(postmon.PostmonModel.cache))
+
+
+class TestSerializacao(unittest.TestCase):
+
+    response = {
+        "bairro": "Bairro B",
+        "cidade": "Cidade C",
+        "cep": "11111111",
+        "logradouro": "Logradouro L",
+        "estado_info": {
+            "area_km2": "999.999,001",
+            "codigo_ibge": "35",
+            "nome": "Estado E"
+        },
+        "cidade_info": {
+            "area_km2": "1099,409",
+            "codigo_ibge": "3549904"
+        },
+        "estado": "SP"
+    }
+
+    def setUp(self):
+        self.endereco = postmon.Endereco(**self.response)
+        self.endereco._response = postmon._RespostaLocal(self.response)
+
+    def assert_endereco(self, e):
+        self.assertEqual('11111111', e.cep)
+        self.assertEqual('Logradouro L', e.logradouro)
+        self.assertTrue(e.complemento is None)
+        self.assertEqual('Bairro B', e.bairro)
+        self.assertEqual('Cidade C', e.cidade.nome)
+        self.assertEqual('SP', e.cidade.uf)
+        self.assertEqual(Decimal('1099.409'), e.cidade.area_km2)
+        self.assertEqual('3549904', e.cidade.codigo_ibge)
+        self.assertEqual('Estado E', e.estado.nome)
+        self.assertEqual(Decimal('999999.001'), e.estado.area_km2)
+        self.assertEqual((200, 'OK'), e.status)
+        self.assertEqual(str(self.endereco), str(e))
+
+    def test_to_dict(self):
+        self.assertEqual({'c': '11111111', 'l': 'Logradouro L',
+                          'b': 'Bairro B', 'ok': 1,
+                          'e': {'u': 'SP', 'n': 'Estado E',
+                                'a': '999999.001', 'i': '35'},
+                          'ci': {'n': 'Cidade C', 'a': '1099.409',
+                                 'i': '3549904'}},
+                         self.endereco.to_dict())
+
+    def test_from_dict(self):
+        self.assert_endereco(
+            postmon.Endereco.from_dict(self.endereco.to_dict()))
+
+    def test_nao_buscado(self):
+        e = postmon.Endereco.from_dict(postmon.Endereco('1').to_dict())
+        self.assertTrue(e.status is None)
+        self.assertEqual('CEP 1', str(e))
+
+    def test_cidade_estado(self):
+        c = postmon.Cidade('mg', 'Belo Horizonte', '331,401', '3106200')
+        c = postmon.Cidade.from_dict(c.to_dict())
+        self.assertEqual(Decimal('331.401'), c.area_km2)
+        self.assertEqual('%s/cidade/MG/Belo Horizonte' % BASE_URL, c.url)
+        u = postmon.Estado.from_dict(postmon.Estado('mg').to_dict())
+        self.assertEqual('MG', u.uf)
+        self.assertTrue(u.area_km2 is None)
+
+    def test_pickle(self):
+        dados = pickle.dumps(self.endereco, pickle.HIGHEST_PROTOCOL)
+        self.assertFalse(b'Response' in dados)
+        self.assert_endereco(pickle.loads(dados))
+
+    def test_pickle_menor_que_resposta_requests(self):
+        resposta = requests.Response()
+        resposta.status_code = 200
+        resposta._content = json.dumps(self.response).encode()
+        self.endereco._response = resposta
+        compacto = pickle.dumps(self.endereco)
+        self.assertTrue(len(compacto) < len(pickle.dumps(resposta)))
+
+    def test_lote(self):
+        outro = postmon.Endereco('22222222', cidade='Cidade C', estado='SP',
+                                 cidade_info=self.response['cidade_info'],
+                                 estado_info=self.response['estado_info'])
+        estado = postmon.Estado('SP', 'Estado E', '999.999,001', '35')
+        cidade = postmon.Cidade('MG', 'Belo Horizonte')
+        dados = postmon.serializar([self.endereco, outro, estado, cidade])
+        # cidade e estado repetidos são gravados uma vez
+        self.assertEqual(3, len(dados['t']))
+        objetos = postmon.desserializar(json.loads(json.dumps(dados)))
+        self.assert_endereco(objetos[0])
+        self.assertEqual('22222222', objetos[1].cep)
+        self.assertTrue(objetos[1].status is None)
+        self.assertEqual('Cidade C', objetos[1].cidade.nome)
+        self.assertEqual(Decimal('999999.001'), objetos[2].area_km2)
+        self.assertEqual('Belo Horizonte - MG', str(objetos[3]))
+
+    def test_lote_versao_invalida(self):
+        self.assertRaises(ValueError, postmon.desserializar,
+                          {'v': 99, 't': [], 'o': []})
+
+    @unittest.skipIf(postmon.msgpack is None, 'msgpack não instalado')
+    def test_empacotar(self):
+        dados = postmon.empacotar([self.endereco, self.endereco])
+        objetos = postmon.desempacotar(dados)
+        self.assertEqual(2, len(objetos))
+        self.assert_endereco(objetos[1])
+
+    def test_empacotar_sem_msgpack(self):
+        with mock.patch('postmon.msgpack', None):
+            self.assertRaises(ImportError, postmon.empacotar, [])
+            self.assertRaises(ImportError, postmon.desempacotar, b'')
+
+
+class TestServidorPostmon(unittest.TestCase):
+
+    response = {"cep": "11111111", "cidade": "Cidade C", "estado": "MG"}
+    cidade = {"area_km2": "331,401", "codigo_ibge": "3106200"}
+    estado = {"area_km2": "586.522,122", "codigo_ibge": "31",
+              "nome": "Minas Gerais"}
+
+    def setUp(self):
+        self.replay = postmon.TransporteReplay({
+            '%s/cep/11111111' % BASE_URL: (200, 'OK',
+                                           json.dumps(self.response)),
+            '%s/cidade/MG/Belo Horizonte' % BASE_URL: (
+                200, 'OK', json.dumps(self.cidade)),
+            '%s/uf/MG' % BASE_URL: (200, 'OK', json.dumps(self.estado)),
+            '%s/cep/22222222' % BASE_URL: (404, 'CEP NAO ENCONTRADO', ''),
+        })
+        self.transporte = mock.Mock(wraps=self.replay)
+        postmon.PostmonModel.transporte = self.transporte
+        postmon.PostmonModel.cache = postmon.CacheMemoria()
+        self.servidor = postmon.ServidorPostmon(('127.0.0.1', 0))
+        t = threading.Thread(target=self.servidor.serve_forever,
+                             kwargs={'poll_interval': 0.01})
+        t.daemon = True
+        t.start()
+        self.url = 'http://127.0.0.1:%d' % self.servidor.server_address[1]
+
+    def tearDown(self):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+        postmon.PostmonModel.transporte = None
+        postmon.PostmonModel.cache = None
+
+    def get(self, caminho):
+        return requests.get(self.url + caminho)
+
+    def test_cep(self):
+        r = self.get('/v1/cep/11111111')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(self.response, r.json())
+
+    def test_cidade(self):
+        r = self.get('/v1/cidade/MG/Belo%20Horizonte')
+        self.assertEqual(self.cidade, r.json())
+
+    def test_uf(self):
+        self.assertEqual(self.estado, self.get('/v1/uf/MG').json())
+
+    def test_cep_nao_encontrado(self):
+        r = self.get('/v1/cep/22222222')
+        self.assertEqual(404, r.status_code)
+        self.assertEqual('CEP NAO ENCONTRADO', r.reason)
+
+    def test_postmon_indisponivel(self):
+        self.assertEqual(503, self.get('/v1/uf/SP').status_code)
+
+    def test_rota_inexistente(self):
+        self.assertEqual(404, self.get('/v1/outra').status_code)
+
+    def test_segmentos_invalidos(self):
+        for caminho in ['/v1/cep/..%2Fuf%2FMG', '/v1/cep/1234',
+                        '/v1/uf/M%2FG', '/v1/uf/..',
+                        '/v1/cidade/MG/..', '/v1/cidade/MG/a%2F..%2Fb',
+                        '/v1/cidade/..%2F/x']:
+            self.assertEqual(404, self.get(caminho).status_code, caminho)
+        self.assertFalse(self.transporte.get.called)
+        self.assertEqual(0, len(postmon.PostmonModel.cache))
+
+    def test_cache(self):
+        self.get('/v1/cep/11111111')
+        self.get('/v1/cep/11111111')
+        self.assertEqual(1, self.transporte.get.call_count)
+
+    def test_coalescencia(self):
+        self.replay.latencia = 0.2
+        respostas = []
+        _em_paralelo(lambda i: respostas.append(
+            self.get('/v1/cep/11111111').json()))
+        self.assertEqual([self.response] * 8, respostas)
+        self.assertEqual(1, self.transporte.get.call_count)
+        # as requisições que chegam depois da busca usam o cache
+        coalescidas = self.servidor.contadores.valores()['coalescidas']
+        self.assertTrue(coalescidas >= 1)
+
+    def test_stats(self):
+        self.get('/v1/cep/11111111')
+        self.get('/v1/cep/22222222')
+        stats = self.get('/stats').json()
+        self.assertEqual(1, stats['servidor']['status_200'])
+        self.assertEqual(1, stats['servidor']['status_404'])
+        self.assertEqual(3, stats['servidor']['requisicoes'])
+        self.assertTrue(stats['buscas']['buscas'] >= 2)
+
+
+class TestMain(unittest.TestCase):
+
+    def tearDown(self):
+        postmon.PostmonModel.base_url = BASE_URL
+        postmon.PostmonModel.cache = None
+        postmon.PostmonModel.cache_ttl = None
+        postmon.PostmonModel.transporte = None
+
+    @mock.patch('postmon.ServidorPostmon')
+    def test_serve(self, servidor):
+        servidor.return_value.server_address = ('0.0.0.0', 9000)
+        r = postmon.main(['serve', '--host', '0.0.0.0', '--port', '9000',
+                          '--cache-maximo', '10', '--cache-ttl', '60'])
+        self.assertEqual(0, r)
+        servidor.assert_called_once_with(('0.0.0.0', 9000))
+        self.assertTrue(servidor.return_value.serve_forever.called)
+        self.assertEqual(10, postmon.PostmonModel.cache.maximo)
+        self.assertEqual(60, postmon.PostmonModel.cache_ttl)
+
+    @mock.patch('postmon.ServidorPostmon')
+    def test_serve_snapshot(self, servidor):
+        servidor.return_value.server_address = ('127.0.0.1', 8080)
+        dir_ = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_)
+        caminho = os.path.join(dir_, 'postmon.snap')
+        postmon.exportar_snapshot(caminho, postmon.CacheMemoria())
+        postmon.main(['serve', '--snapshot', caminho])
+        self.assertTrue(isinstance(postmon.PostmonModel.cache,
+                                   postmon.CacheSnapshot))
+        postmon.PostmonModel.cache.fechar()
+
+    def test_sem_comando(self):
+        with mock.patch('sys.stdout'):
+            self.assertEqual(2, postmon.main([]))
+
+
+class TestCadeiaProvedores(unittest.TestCase):
+
+    response = {
+        "area_km2": "586.522,122",
+        "codigo_ibge": "31",
+        "nome": "Minas Gerais"
+    }
+
+    def setUp(self):
+        corpo = json.dumps(self.response)
+        self.primario = postmon.TransporteReplay({
+            'http://primario/v1/uf/MG': (200, 'OK', corpo),
+            'http://primario/v1/uf/XX': (404, 'NAO ENCONTRADO', ''),
+            'http://primario/v1/uf/RJ': (503, 'SERVICO INDISPONIVEL', ''),
+        })
+        self.secundario = mock.Mock(wraps=postmon.TransporteReplay({
+            'http://secundario/v1/uf/MG': (200, 'OK', corpo),
+            'http://secundario/v1/uf/RJ': (200, 'OK', corpo),
+        }))
+        self.cache = postmon.CacheMemoria()
+        self.cadeia = postmon.CadeiaProvedores([
+            postmon.ProvedorLocal({'/uf/SP': dict(self.response,
+                                                  nome='Sao Paulo')}),
+            postmon.ProvedorCache(self.cache),
+            postmon.ProvedorPostmon('http://primario/v1', 0.05,
+                                    self.primario),
+            postmon.ProvedorPostmon('http://secundario/v1', 0.05,
+                                    self.secundario),
+        ])
+        postmon.PostmonModel.provedores = self.cadeia
+
+    def tearDown(self):
+        postmon.PostmonModel.provedores = None
+
+    def test_local(self):
+        self.assertEqual('Sao Paulo', postmon.estado('SP').nome)
+        self.assertFalse(self.secundario.get.called)
+
+    def test_local_caminho_normalizado(self):
+        postmon.PostmonModel.provedores = postmon.CadeiaProvedores([
+            postmon.ProvedorLocal({
+                '/uf/SP': dict(self.response, nome='Sao Paulo'),
+                '/cep/01419101': {'cep': '01419101', 'cidade': 'Sao Paulo',
+                                  'estado': 'SP'}}),
+            postmon.ProvedorPostmon('http://secundario/v1', 0.05,
+                                    self.secundario),
+        ])
+        self.assertEqual('Sao Paulo', postmon.estado('sp').nome)
+        self.assertEqual('Sao Paulo',
+                         postmon.endereco('01419-101').cidade.nome)
+        self.assertFalse(self.secundario.get.called)
+
+    def test_primario(self):
+        e = postmon.estado('MG')
+        self.assertEqual('Minas Gerais', e.nome)
+        self.assertEqual((200, 'OK'), e.status)
+        self.assertFalse(self.secundario.get.called)
+
+    def test_guarda_no_cache(self):
+        postmon.estado('MG')
+        self.assertEqual(self.response,
+                         self.cache.get('%s/uf/MG' % BASE_URL))
+
+    def test_cache(self):
+        self.cache.set('%s/uf/AC' % BASE_URL, dict(self.response, nome='Acre'))
+        self.assertEqual('Acre', postmon.estado('AC').nome)
+
+    def test_primario_lento(self):
+        self.primario.latencia = 1
+        inicio = time.time()
+        self.assertEqual('Minas Gerais', postmon.estado('MG').nome)
+        self.assertTrue(time.time() - inicio < 0.5)
+        self.assertTrue(self.secundario.get.called)
+
+    def test_primario_envia_resposta_aos_poucos(self):
+        # o timeout do transporte vale para cada leitura do socket, então
+        # não limita uma resposta enviada aos poucos
+        class TransporteLento(object):
+            def get(self, url, headers, timeout=None):
+                time.sleep(1)
+                return primario.get(url, headers, timeout)
+
+        primario = self.primario
+        self.cadeia.provedores[2].transporte = TransporteLento()
+        inicio = time.time()
+        self.assertEqual('Minas Gerais', postmon.estado('MG').nome)
+        self.assertTrue(time.time() - inicio < 0.5)
+        self.assertTrue(self.secundario.get.called)
+
+    def test_fonte_degradada_limita_chamadas_pendentes(self):
+        chamadas = []
+
+        class TransporteLento(object):
+            def get(self, url, headers, timeout=None):
+                chamadas.append(url)
+                time.sleep(0.3)
+                raise requests.Timeout('lento')
+
+        self.cadeia = postmon.CadeiaProvedores([
+            postmon.ProvedorPostmon('http://primario/v1', 0.02,
+                                    TransporteLento(), max_pendentes=2),
+            postmon.ProvedorPostmon('http://secundario/v1', 0.5,
+                                    self.secundario),
+        ])
+        postmon.PostmonModel.provedores = self.cadeia
+        for _ in range(20):
+            self.assertEqual('Minas Gerais', postmon.estado('MG').nome)
+        executor = self.cadeia._executores[0]
+        self.assertTrue(len(chamadas) <= 4)
+        self.assertTrue(executor.em_andamento() <= 2)
+        self.assertTrue(executor._threads <= 2)
+
+    def test_pickle(self):
+        cadeia = postmon.CadeiaProvedores([
+            postmon.ProvedorLocal({}),
+            postmon.ProvedorPostmon('http://primario/v1', 0.05,
+                                    self.primario)])
+        copia = pickle.loads(pickle.dumps(cadeia))
+        self.assertEqual(2, len(copia.provedores))
+        self.assertTrue(copia._executores[0] is None)
+        self.assertEqual(0, copia._executores[1].em_andamento())
+
+    def test_transporte_do_modelo(self):
+        replay = mock.Mock(wraps=postmon.TransporteReplay({
+            'http://outra/v1/uf/MG': (200, 'OK', json.dumps(self.response))}))
+        postmon.PostmonModel.transporte = replay
+        postmon.PostmonModel.provedores = postmon.CadeiaProvedores([
+            postmon.ProvedorPostmon('http://outra/v1')])
+        try:
+            self.assertEqual('Minas Gerais', postmon.estado('MG').nome)
+        finally:
+            postmon.PostmonModel.transporte = None
+        self.assertTrue(replay.get.called)
+
+    def test_orcamento_obrigatorio(self):
+        self.assertRaises(ValueError, postmon.ProvedorPostmon,
+                          'http://primario/v1', None)
+        self.assertEqual(2.0,
+                         postmon.ProvedorPostmon('http://primario/v1')
+                         .orcamento)
+
+    def test_primario_fora(self):
+        self.assertEqual('Minas Gerais', postmon.estado('RJ').nome)
+
+    def test_nao_encontrado_encerra_a_cadeia(self):
+        e = postmon.Estado('XX')
+        self.assertFalse(e.buscar())
+        self.assertEqual((404, 'NAO ENCONTRADO'), e.status)
+        self.assertFalse(self.secundario.get.called)
+
+    def test_todos_falham(self):
+        self.assertTrue(postmon.estado('AM') is None)
+
+    def test_converter(self):
+        class ProvedorOutraApi(postmon.ProvedorPostmon):
+            def url(self, obj):
+                return '%s/estados/%s' % (self.base_url, obj.uf)
+
+            def converter(self, dados):
+                return {'nome': dados['name'], 'area_km2': None,
+                        'codigo_ibge': dados['ibge']}
+
+        transporte = postmon.TransporteReplay({
+            'http://outra/estados/PR': (200, 'OK',
+                                        '{"name": "Parana", "ibge": "41"}')})
+        postmon.PostmonModel.provedores = postmon.CadeiaProvedores([
+            ProvedorOutraApi('http://outra', transporte=transporte)])
+        e = postmon.estado('PR')
+        self.assertEqual('Parana', e.nome)
+        self.assertEqual('41', e.codigo_ibge)
+
+
+class TestTimeoutTransporte(unittest.TestCase):
+
+    @mock.patch('postmon.requests.get')
+    def test_requests(self, mock_get):
+        postmon.TransporteRequests().get('url', {}, 0.5)
+        mock_get.assert_called_once_with('url', headers={}, timeout=0.5)
+
+    @mock.patch('postmon.time.sleep')
+    def test_replay(self, sleep):
+        replay = postmon.TransporteReplay({'url': (200, 'OK', '{}')},
+                                          latencia=1)
+        self.assertRaises(requests.Timeout, replay.get, 'url', {}, 0.1)
+        sleep.assert_called_once_with(0.1)
+
+
+class TestRastreadorAcessos(unittest.TestCase):
+
+    def setUp(self):
+        self.rastreador = postmon.RastreadorAcessos(k=3, amostra=100)
+
+    def tearDown(self):
+        postmon.PostmonModel.rastreador = None
+        postmon.PostmonModel.transporte = None
+        postmon.PostmonModel.cache = None
+
+    def registrar(self, *chaves):
+        for chave in chaves:
+            self.rastreador.registrar(chave)
+
+    def test_mais_buscadas(self):
+        self.registrar('a', 'b', 'a', 'c', 'a', 'b')
+        self.assertEqual([('a', 3, 0), ('b', 2, 0), ('c', 1, 0)],
+                         self.rastreador.mais_buscadas())
+        self.assertEqual([('a', 3, 0)], self.rastreador.mais_buscadas(1))
+
+    def test_space_saving(self):
+        self.registrar('a', 'a', 'a', 'b', 'b', 'c', 'd')
+        # 'd' substitui 'c', herdando a sua contagem como erro
+        self.assertEqual([('a', 3, 0), ('b', 2, 0), ('d', 2, 1)],
+                         self.rastreador.mais_buscadas())
+        self.assertEqual(7, self.rastreador.total)
+
+    def test_space_saving_garantias(self):
+        gerador = random.Random(1)
+        rastreador = postmon.RastreadorAcessos(k=20, amostra=10)
+        reais = {}
+        for _ in range(5000):
+            chave = 'k%d' % int(gerador.paretovariate(1.2))
+            reais[chave] = reais.get(chave, 0) + 1
+            rastreador.registrar(chave)
+        itens = rastreador.mais_buscadas()
+        self.assertEqual(20, len(itens))
+        self.assertEqual(5000, sum(n for _, n, _ in itens))
+        for chave, n, erro in itens:
+            self.assertTrue(n - erro <= reais[chave] <= n)
+        self.assertEqual(min(n for _, n, _ in itens), rastreador._minimo)
+        self.assertEqual(20, sum(len(g) for g in rastreador._grupos.values()))
+
+    def test_memoria_limitada(self):
+        self.registrar(*['k%d' % i for i in range(1000)])
+        self.assertEqual(3, len(self.rastreador.mais_buscadas()))
+        self.assertEqual(100, len(self.rastreador._recentes))
+        self.assertEqual(100, len(self.rastreador._vistas))
+
+    def test_taxa_acerto(self):
+        self.registrar('a', 'b', 'a', 'b', 'c', 'a')
+        self.assertEqual(0.0, self.rastreador.taxa_acerto(0))
+        self.assertEqual(0.0, self.rastreador.taxa_acerto(1))
+        self.assertEqual(2 / 6.0, self.rastreador.taxa_acerto(2))
+        self.assertEqual(3 / 6.0, self.rastreador.taxa_acerto(3))
+        self.assertEqual(0.0, postmon.RastreadorAcessos().taxa_acerto(10))
+
+    def test_intervalos(self):
+        r = self.rastreador
+        r.registrar('a', agora=0)
+        r.registrar('a', agora=3)
+        r.registrar('a', agora=6)
+        r.registrar('b', agora=6)
+        r.registrar('b', agora=6)
+        self.assertEqual([(2 ** -10, 1), (4, 2)], r.intervalos())
+
+    def test_exportar_prewarm(self):
+        self.registrar('/uf/MG', '/uf/SP', '/uf/MG')
+        self.assertEqual(['/uf/MG', '/uf/SP'],
+                         self.rastreador.exportar_prewarm())
+
+    def test_buscar_registra(self):
+        postmon.PostmonModel.rastreador = self.rastreador
+        postmon.PostmonModel.transporte = postmon.TransporteReplay({})
+        postmon.estado('MG')
+        postmon.cidade('mg', 'Belo Horizonte')
+        postmon.endereco('11111111')
+        postmon.endereco('11111-111')
+        postmon.estado('mg')
+        self.assertEqual([('/cep/11111111', 2, 0),
+                          ('/uf/MG', 2, 0),
+                          ('/cidade/MG/Belo Horizonte', 1, 0)],
+                         self.rastreador.mais_buscadas())
+
+    def test_preaquecer(self):
+        response = {"area_km2": None, "codigo_ibge": "31",
+                    "nome": "Minas Gerais"}
+        postmon.PostmonModel.transporte = postmon.TransporteReplay({
+            '%s/uf/MG' % BASE_URL: (200, 'OK', json.dumps(response))})
+        postmon.PostmonModel.cache = postmon.CacheMemoria()
+        self.assertEqual(1, postmon.preaquecer(['/uf/MG', '/uf/XX',
+                                                '/outro']))
+        self.assertEqual(response,
+                         postmon.PostmonModel.cache.get('%s/uf/MG' % BASE_URL))
+
+    def test_preaquecer_formatos_de_cep(self):
+        response = {"cep": "01419101", "cidade": "Sao Paulo", "estado": "SP"}
+        replay = postmon.TransporteReplay({
+            '%s/cep/01419-101' % BASE_URL: (200, 'OK', json.dumps(response)),
+            '%s/cep/01419101' % BASE_URL: (200, 'OK', json.dumps(response))})
+        postmon.PostmonModel.transporte = replay
+        postmon.PostmonModel.rastreador = self.rastreador
+        postmon.endereco('01419-101')
+        postmon.endereco('01419101')
+        # as duas buscas usam a mesma entrada do cache
+        self.assertEqual(0.5, self.rastreador.taxa_acerto(10))
+
+        postmon.PostmonModel.rastreador = None
+        postmon.PostmonModel.cache = postmon.CacheMemoria()
+        self.assertEqual(1, postmon.preaquecer(
+            self.rastreador.exportar_prewarm()))
+        postmon.PostmonModel.transporte = mock.Mock(wraps=replay)
+        self.assertEqual('Sao Paulo',
+                         postmon.endereco('01419-101').cidade.nome)
+        self.assertFalse(postmon.PostmonModel.transporte.get.called)